@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+__author__ = "Dustin Rasener"
+__version__ = "0.1.0"
+__license__ = "Proprietary"
+
+import argparse
+import json
+import os
+from datetime import date, timedelta
+from functools import partial
+from logzero import logger, loglevel, logfile
+from common import (event_matches, add_fetch_arguments, close_fetcher, fetcher_from_args, pool_from_args, chunked,
+                    LOCATIONS, RACE_TYPES)
+from get_resulted import (fetch_resulted_event_list, import_resulted_events, RESULTED_PROFILE_FIELDS,
+                          RESULTED_PROFILE_MAPPERS)
+from metrics import add_metrics_arguments, metrics_from_args, report_metrics
+from run_jobs import partition_events
+
+logfile("/tmp/backfill.log", maxBytes=int(1e6), backupCount=10)
+
+
+def date_range(start, end):
+    """ Every date from `start` to `end`, inclusive, most recent first """
+    day = end
+    while day >= start:
+        yield day
+        day -= timedelta(days=1)
+
+
+class Checkpoint:
+    """ Progress of a backfill, saved to a JSON file after every step so that an interrupted backfill can resume.
+
+    For each date it keeps the race types its list was fetched for, the events that were listed ({event_id:
+    race_type}) and the ones already imported. A date whose list has not been fetched yet is missing from `dates`,
+    and one that was only listed for some race types is listed again when a backfill asks for another. """
+
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            with open(filename) as f:
+                self.state = json.load(f)
+        except (OSError, ValueError):
+            self.state = {"dates": {}}
+
+    def listed(self, day, race_types):
+        """ Whether the list of a date was fetched for every one of `race_types` """
+        progress = self.state["dates"].get(day.isoformat())
+        return progress is not None and set(race_types) <= set(progress.get("race_types", []))
+
+    def set_listed(self, day, race_types, event_race_types):
+        """ Record the events listed on a date for `race_types`, keeping what an earlier listing found and imported """
+        progress = self.state["dates"].setdefault(day.isoformat(), {"race_types": [], "events": {}, "imported": []})
+        progress["race_types"] = sorted(set(progress.get("race_types", [])) | set(race_types))
+        progress["events"].update(event_race_types)
+        self.save()
+
+    def pending(self, start, end, race_types):
+        """ {event_id: race_type} of every event listed between two dates, inclusive, and of one of `race_types`,
+        that has not been imported yet """
+        pending = {}
+        for day, progress in self.state["dates"].items():
+            if not start.isoformat() <= day <= end.isoformat():
+                continue
+            imported = set(progress["imported"])
+            pending.update({k: v for k, v in progress["events"].items() if k not in imported and v in race_types})
+        return pending
+
+    def set_imported(self, event_ids):
+        event_ids = {str(x) for x in event_ids}
+        for progress in self.state["dates"].values():
+            progress["imported"].extend(x for x in progress["events"] if x in event_ids)
+        self.save()
+
+    def save(self):
+        with open(f"{self.filename}.tmp", "w") as f:
+            json.dump(self.state, f)
+        os.replace(f"{self.filename}.tmp", self.filename)
+
+
+def backfill(fetcher, start, end, race_types, checkpoint, output_dir=".", save_source=False, batch_size=10,
+             stream=False, chunk_size=100, pool=None, today=None):
+    """ Import the results of every race between two dates. The resulted event list of each date is fetched once,
+    then the details of every listed race go through the fetcher's shared, rate-limited workers, `chunk_size`
+    races at a time, with the checkpoint saved after each list and each chunk. Races that were already imported
+    are skipped, so running the same backfill again resumes it. """
+    today = date.today() if today is None else today
+    in_locations = partial(event_matches, locations=LOCATIONS)
+    for day in date_range(start, end):
+        if checkpoint.listed(day, race_types):
+            continue
+        events = fetch_resulted_event_list(fetcher, (today - day).days, stream=stream, predicate=in_locations)
+        jobs = {str(k): v for k, v in partition_events(events, race_types).items()}
+        logger.info(f"Found {len(jobs)} resulted events on {day.isoformat()}")
+        checkpoint.set_listed(day, race_types, jobs)
+
+    pending = checkpoint.pending(start, end, race_types)
+    logger.info(f"{len(pending)} results left to import")
+    event_ids = list(pending)
+    for i, chunk in enumerate(chunked(event_ids, chunk_size)):
+        imported = import_resulted_events(fetcher, {x: pending[x] for x in chunk}, output_dir=output_dir,
+                                          save_source=save_source, batch_size=batch_size, stream=stream, pool=pool)
+        checkpoint.set_imported(imported)
+        logger.info(f"Imported {min((i + 1) * chunk_size, len(event_ids))} of {len(event_ids)} results")
+    failed = len(checkpoint.pending(start, end, race_types))
+    if failed:
+        logger.warning(f"{failed} results could not be imported; run the backfill again to retry them")
+    return failed
+
+
+def main(args):
+    loglevel((5 - args.verbose) * 10)  # -v for error+critical, up to -vvvv for debug+
+    exporter = metrics_from_args(args)
+    race_types = args.race_types.split(",")
+    for race_type in race_types:
+        if race_type not in RACE_TYPES:
+            raise ValueError(f"Unknown race type {race_type}")
+    start = date.fromisoformat(args.start)
+    end = date.fromisoformat(args.end) if args.end is not None else date.today() - timedelta(days=1)
+    if start > end:
+        raise ValueError(f"Start date {start} is after end date {end}")
+    fetcher = fetcher_from_args(args, RESULTED_PROFILE_FIELDS, RESULTED_PROFILE_MAPPERS)
+    os.makedirs(args.output_dir, exist_ok=True)
+    pool = pool_from_args(args)
+    backfill(fetcher, start, end, race_types, Checkpoint(args.checkpoint),
+             output_dir=args.output_dir,
+             save_source=args.save_source,
+             batch_size=args.batch_size,
+             stream=args.stream,
+             chunk_size=args.chunk_size,
+             pool=pool)
+    if pool is not None:
+        pool.shutdown()
+    close_fetcher(fetcher, args)
+    report_metrics(args, exporter)
+
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-o", "--output_dir", action="store", dest="output_dir", default="resulted")
+    parser.add_argument("--from", action="store", dest="start", required=True,
+                        help="First date to get results for, as YYYY-MM-DD")
+    parser.add_argument("--to", action="store", dest="end", default=None,
+                        help="Last date to get results for, as YYYY-MM-DD (defaults to yesterday)")
+    parser.add_argument("-r", "--race-types", action="store", dest="race_types",
+                        default="HORSE_RACING,HARNESS_RACING,GREYHOUNDS",
+                        help="Comma-separated race types (defaults to HORSE_RACING,HARNESS_RACING,GREYHOUNDS)")
+    parser.add_argument("--checkpoint", action="store", dest="checkpoint", default="backfill-checkpoint.json",
+                        help="File to keep progress in, so that an interrupted backfill can be resumed "
+                             "(defaults to backfill-checkpoint.json; keep it outside the output directory)")
+    parser.add_argument("--chunk-size", action="store", dest="chunk_size", type=int, default=100,
+                        help="Number of races to import between checkpoints (defaults to 100)")
+    parser.add_argument("-s", "--save-source-data", action="store_true", dest="save_source", default=False,
+                        help="Save source data files for debugging (warning: large files -- 3-6MB each)")
+    add_fetch_arguments(parser)
+    add_metrics_arguments(parser)
+
+    # Optional verbosity counter (eg. -v, -vv, -vvv, etc.)
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="count",
+        default=0,
+        help="Verbosity (-v, -vv, etc)")
+
+    # Specify output of "--version"
+    parser.add_argument(
+        "--version",
+        action="version",
+        version="%(prog)s (version {version})".format(version=__version__))
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+""" Micro-benchmark of the precompiled data map accessors against the original `map_data` implementation.
+
+Source records are rebuilt from the sample outputs in events.zip by writing each output value back to the
+dot-notated path its data map reads it from, so both implementations see realistic shapes and values. """
+import argparse
+import json
+import os
+import sys
+import timeit
+import zipfile
+from copy import deepcopy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from common import compile_mapping  # noqa: E402
+from get_upcoming import UPCOMING_RACE_DATA_MAPPING, UPCOMING_RACE_GROUP_MAPPINGS  # noqa: E402
+
+DEFAULT_FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "events.zip")
+FIXTURE_GROUP_KEYS = {"index": "position"}  # the sample outputs predate the rename of `index` to `position`
+
+
+def legacy_map_data(source_data, mapping):
+    """ `map_data` as it was before the data maps were precompiled (with the list bounds check fixed) """
+    def find(element, json):
+        keys = element.split('.')
+        value = json
+        for key in keys:
+            if isinstance(value, dict):
+                if value is not None and key in value:
+                    value = value[key]
+                else:
+                    return None
+            elif isinstance(value, list):
+                try:
+                    index = int(key)
+                except ValueError:
+                    return None
+                if len(value) > index:
+                    value = value[index]
+                else:
+                    return None
+        return value
+    dest_data = deepcopy(mapping)
+    for key in dest_data:
+        dest_data[key] = find(mapping[key], source_data)
+    return dest_data
+
+
+def unmap(record, mapping, renames=None):
+    """ Build a source record that `mapping` maps back to `record` """
+    renames = renames or {}
+    source = {}
+    for key, value in record.items():
+        key = renames.get(key, key)
+        if key not in mapping:
+            continue
+        *parents, leaf = mapping[key].split('.')
+        node = source
+        for parent in parents:
+            node = node.setdefault(parent, {})
+        node[leaf] = value
+    return source
+
+
+def load_fixtures(path):
+    events = []
+    runners = []
+    with zipfile.ZipFile(path) as archive:
+        for name in archive.namelist():
+            if not name.endswith(".json"):
+                continue
+            record = json.loads(archive.read(name))
+            events.append(unmap(record, UPCOMING_RACE_DATA_MAPPING))
+            runners.extend(unmap(x, UPCOMING_RACE_GROUP_MAPPINGS["HORSE_RACING"], FIXTURE_GROUP_KEYS)
+                           for x in record.get("group", []))
+    return events, runners
+
+
+def main(args):
+    events, runners = load_fixtures(args.fixtures)
+    event_mapper = compile_mapping(UPCOMING_RACE_DATA_MAPPING)
+    runner_mapper = compile_mapping(UPCOMING_RACE_GROUP_MAPPINGS["HORSE_RACING"])
+
+    def run_legacy():
+        return ([legacy_map_data(x, UPCOMING_RACE_DATA_MAPPING) for x in events],
+                [legacy_map_data(x, UPCOMING_RACE_GROUP_MAPPINGS["HORSE_RACING"]) for x in runners])
+
+    def run_compiled():
+        return [event_mapper(x) for x in events], [runner_mapper(x) for x in runners]
+
+    assert run_legacy() == run_compiled(), "Compiled data maps do not match map_data output"
+    legacy = min(timeit.repeat(run_legacy, number=args.number, repeat=args.repeat)) / args.number
+    compiled = min(timeit.repeat(run_compiled, number=args.number, repeat=args.repeat)) / args.number
+    records = len(events) + len(runners)
+    print(json.dumps({
+        "records": records,
+        "legacy_records_per_sec": round(records / legacy),
+        "compiled_records_per_sec": round(records / compiled),
+        "speedup": round(legacy / compiled, 2)
+    }, indent=4))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--fixtures", action="store", dest="fixtures", default=DEFAULT_FIXTURES,
+                        help="Zip file of sample outputs (defaults to events.zip)")
+    parser.add_argument("-n", "--number", action="store", dest="number", type=int, default=20)
+    parser.add_argument("-r", "--repeat", action="store", dest="repeat", type=int, default=5)
+    main(parser.parse_args())
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+""" Replay a recorded run end to end and report throughput and per-stage latency.
+
+Record a run once with `--record DIR` (e.g. `run_jobs.py --record recordings/today`), then benchmark the whole
+pipeline offline against it. Requests are served by a local replay server, so results do not depend on the TAB
+API or the network. Output is JSON, to be kept alongside the commit it was measured on. """
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from logzero import loglevel
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import common  # noqa: E402
+import get_resulted  # noqa: E402
+import get_upcoming  # noqa: E402
+from common import Fetcher  # noqa: E402
+from metrics import METRICS  # noqa: E402
+from replay import ReplayServer  # noqa: E402
+from run_jobs import run_jobs  # noqa: E402
+
+STAGES = {
+    "fetch": (Fetcher, "request"),
+    "map_upcoming": (get_upcoming, "map_event_info"),
+    "map_resulted": (get_resulted, "map_resulted_event"),
+    "write_upcoming": (get_upcoming, "write_event_info"),
+    "write_resulted": (get_resulted, "write_resulted_event")
+}
+
+
+def timed(fn, samples):
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            samples.append(time.perf_counter() - started)
+    return wrapper
+
+
+def observed(observe, name, samples):
+    """ Wrap Metrics.observe to also keep the samples of one stage """
+    def wrapper(stage, seconds):
+        if stage == name:
+            samples.append(seconds)
+        return observe(stage, seconds)
+    return wrapper
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def summarize(samples):
+    return {"count": len(samples), "total": sum(samples), "p50": percentile(samples, 0.5),
+            "p90": percentile(samples, 0.9), "p99": percentile(samples, 0.99)}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args):
+    loglevel((5 - args.verbose) * 10)
+    samples = {name: [] for name in STAGES}
+    for name, (owner, attribute) in STAGES.items():
+        setattr(owner, attribute, timed(getattr(owner, attribute), samples[name]))
+    # End-to-end latency of each written race, from the start of its fetch
+    samples["latency"] = []
+    METRICS.enable()
+    METRICS.observe = observed(METRICS.observe, "latency", samples["latency"])
+
+    server = ReplayServer(args.recording).start()
+    fetcher = Fetcher(rate=0, concurrency=args.concurrency, base_url=server.url)
+    with tempfile.TemporaryDirectory() as output_dir:
+        started = time.perf_counter()
+        run_jobs(fetcher,
+                 upcoming_days=[x for x in args.upcoming_days.split(",") if x != ""],
+                 resulted_days=[x for x in args.resulted_days.split(",") if x != ""],
+                 race_types=args.race_types.split(","),
+                 output_dir=output_dir,
+                 batch_size=args.batch_size,
+                 stream=args.stream)
+        elapsed = time.perf_counter() - started
+    fetcher.close()
+    server.stop()
+
+    events = len(samples["map_upcoming"]) + len(samples["map_resulted"])
+    result = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "recording": args.recording,
+        "options": {"batch_size": args.batch_size, "concurrency": args.concurrency, "stream": args.stream},
+        "seconds": elapsed,
+        "events": events,
+        "requests": fetcher.request_count,
+        "bytes": fetcher.bytes_received,
+        "events_per_second": events / elapsed if elapsed else None,
+        "bytes_per_second": fetcher.bytes_received / elapsed if elapsed else None,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "stages": {name: summarize(x) for name, x in samples.items()}
+    }
+    output = json.dumps(result, indent=4)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("recording", help="Directory recorded with --record")
+    parser.add_argument("-u", "--upcoming-days", action="store", dest="upcoming_days", default="0,1,2")
+    parser.add_argument("-p", "--resulted-days", action="store", dest="resulted_days", default="0,1")
+    parser.add_argument("-r", "--race-types", action="store", dest="race_types",
+                        default=",".join(common.RACE_TYPES))
+    parser.add_argument("-b", "--batch-size", action="store", dest="batch_size", type=int, default=10)
+    parser.add_argument("-c", "--concurrency", action="store", dest="concurrency", type=int, default=4)
+    parser.add_argument("--stream", action="store_true", dest="stream", default=False)
+    parser.add_argument("--output", action="store", dest="output", default=None,
+                        help="Also write the results to this file")
+    parser.add_argument("-v", "--verbose", action="count", default=1, help="Verbosity (-v, -vv, etc)")
+    main(parser.parse_args())
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+""" Compare the full `json.load` path with incremental parsing (`--stream`) on saved source files.
+
+Takes responses saved with `-s` (`{event_id}-event.json` / `{event_id}-results.json`) or whole event lists
+saved from the list endpoints, and reports wall time, time to first record and peak Python heap for each. """
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from common import stream_json_items, EVENT_LIST_FIELDS  # noqa: E402
+from get_upcoming import UPCOMING_EVENT_FIELDS  # noqa: E402
+from get_resulted import RESULTED_EVENT_FIELDS  # noqa: E402
+
+FIELDS = {
+    "list": EVENT_LIST_FIELDS,
+    "upcoming": UPCOMING_EVENT_FIELDS,
+    "resulted": RESULTED_EVENT_FIELDS
+}
+
+
+def detect_prefix(filename):
+    with open(filename, "rb") as f:
+        head = f.read(4096)
+    return "data.eventResults" if b'"eventResults"' in head else "data.events"
+
+
+def parse_full(filename, prefix):
+    with open(filename, "rb") as f:
+        node = json.load(f)
+        for key in prefix.split("."):
+            node = node[key]
+        yield from node
+
+
+def parse_streaming(filename, prefix, fields):
+    with open(filename, "rb") as f:
+        yield from stream_json_items(f, prefix, fields=fields)
+
+
+def measure(records):
+    started = time.perf_counter()
+    first = None
+    count = 0
+    for _ in records():
+        if first is None:
+            first = time.perf_counter() - started
+        count += 1
+    return {"records": count, "seconds": time.perf_counter() - started, "first_record_seconds": first}
+
+
+def peak_memory(records):
+    tracemalloc.start()
+    kept = list(records())  # mapping keeps every record of a batch alive, so hold them here as well
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del kept
+    return peak
+
+
+def main(args):
+    results = []
+    for filename in args.files:
+        prefix = detect_prefix(filename)
+        kind = args.kind or ("resulted" if prefix == "data.eventResults" else "upcoming")
+        fields = FIELDS[kind]
+        result = {"file": filename, "bytes": os.path.getsize(filename), "kind": kind}
+        for name, records in (("full", lambda: parse_full(filename, prefix)),
+                              ("stream", lambda: parse_streaming(filename, prefix, fields))):
+            result[name] = measure(records)
+            result[name]["peak_bytes"] = peak_memory(records)
+        results.append(result)
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="+", help="Saved source files")
+    parser.add_argument("-k", "--kind", action="store", dest="kind", default=None, choices=sorted(FIELDS),
+                        help="Which field set to keep while streaming (defaults to upcoming or resulted, "
+                             "depending on the file)")
+    main(parser.parse_args())
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+""" Events/sec of a replayed run for a range of worker process counts (`--workers`).
+
+Replays a recording made with `--record DIR` from a local replay server, so that the network is not the
+bottleneck, and runs the whole upcoming and resulted import once per worker count. 0 workers decodes and maps in
+the main process, as without `--workers`. Use the batch size the recording was made with, since other batches
+ask for URLs that were not recorded. """
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from logzero import logger, loglevel
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from common import Fetcher, RACE_TYPES  # noqa: E402
+from replay import ReplayServer  # noqa: E402
+from run_jobs import run_jobs  # noqa: E402
+
+
+def measure(server, workers, args):
+    pool = None
+    if workers > 0:
+        pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("forkserver"),
+                                   initializer=loglevel, initargs=(logger.level,))
+    fetcher = Fetcher(rate=0, concurrency=max(args.concurrency, workers), base_url=server.url)
+    with tempfile.TemporaryDirectory() as output_dir:
+        started = time.perf_counter()
+        run_jobs(fetcher,
+                 upcoming_days=[x for x in args.upcoming_days.split(",") if x != ""],
+                 resulted_days=[x for x in args.resulted_days.split(",") if x != ""],
+                 race_types=args.race_types.split(","),
+                 output_dir=output_dir,
+                 batch_size=args.batch_size,
+                 pool=pool)
+        elapsed = time.perf_counter() - started
+        events = len(os.listdir(output_dir))
+    fetcher.close()
+    if pool is not None:
+        pool.shutdown()
+    return {"workers": workers, "events": events, "seconds": elapsed, "events_per_second": events / elapsed}
+
+
+def main(args):
+    loglevel((5 - args.verbose) * 10)
+    server = ReplayServer(args.recording).start()
+    results = []
+    for workers in [int(x) for x in args.workers.split(",")]:
+        runs = [measure(server, workers, args) for _ in range(args.repeat)]
+        results.append(min(runs, key=lambda x: x["seconds"]))
+    server.stop()
+    print(json.dumps({"cpus": os.cpu_count(), "batch_size": args.batch_size, "results": results}, indent=4))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("recording", help="Directory recorded with --record")
+    parser.add_argument("-w", "--workers", action="store", dest="workers", default="0,1,2,4",
+                        help="Comma-separated worker counts to measure (defaults to 0,1,2,4)")
+    parser.add_argument("-n", "--repeat", action="store", dest="repeat", type=int, default=3,
+                        help="Runs per worker count; the fastest is reported (defaults to 3)")
+    parser.add_argument("-u", "--upcoming-days", action="store", dest="upcoming_days", default="0,1,2")
+    parser.add_argument("-p", "--resulted-days", action="store", dest="resulted_days", default="0,1")
+    parser.add_argument("-r", "--race-types", action="store", dest="race_types", default=",".join(RACE_TYPES))
+    parser.add_argument("-b", "--batch-size", action="store", dest="batch_size", type=int, default=10)
+    parser.add_argument("-c", "--concurrency", action="store", dest="concurrency", type=int, default=4)
+    parser.add_argument("-v", "--verbose", action="count", default=1, help="Verbosity (-v, -vv, etc)")
+    main(parser.parse_args())
@@ -0,0 +1,112 @@
+import gzip
+import json
+import os
+import zlib
+from logzero import logger
+
+MANIFEST_SUFFIX = ".manifest"
+
+
+class BundleWriter:
+    """ Writes every record of a run as compact newline-delimited JSON into one gzip file, instead of one
+    pretty-printed file per race.
+
+    Each line is {"kind", "event_id", "filename", "data"}, where `data` is exactly what the per-race file would
+    have held and `filename` is the name it would have had. Records are compressed in blocks of `block_size`, each
+    its own gzip member, so a reader can seek straight to a block. A manifest of block offsets and record
+    positions is written next to the bundle (`<bundle>.manifest`) on close. """
+
+    def __init__(self, path, block_size=100):
+        self.path = path
+        self.block_size = max(int(block_size), 1)
+        self.temp_path = f"{path}.tmp"
+        self.file = open(self.temp_path, "wb")
+        self.manifest = {"bundle": os.path.basename(path), "records": 0, "blocks": [], "entries": []}
+        self.block = []
+
+    def write(self, kind, event_id, data, filename):
+        line = json.dumps({"kind": kind, "event_id": str(event_id), "filename": os.path.basename(filename),
+                           "data": data}, separators=(",", ":"))
+        self.manifest["entries"].append({"kind": kind, "event_id": str(event_id),
+                                         "filename": os.path.basename(filename),
+                                         "block": len(self.manifest["blocks"]), "line": len(self.block)})
+        self.block.append(line)
+        self.manifest["records"] += 1
+        if len(self.block) >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if not self.block:
+            return
+        offset = self.file.tell()
+        self.file.write(gzip.compress(("\n".join(self.block) + "\n").encode("utf-8")))
+        self.manifest["blocks"].append({"offset": offset, "length": self.file.tell() - offset,
+                                        "records": len(self.block)})
+        self.block = []
+
+    def close(self):
+        """ Finish the bundle and its manifest. Both are renamed into place only once complete. """
+        self.flush()
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+        with open(f"{self.path}{MANIFEST_SUFFIX}.tmp", "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(f"{self.path}{MANIFEST_SUFFIX}.tmp", f"{self.path}{MANIFEST_SUFFIX}")
+        logger.info(f"Wrote {self.manifest['records']} records in {len(self.manifest['blocks'])} blocks "
+                    f"to {self.path}")
+        return self.manifest
+
+
+class BundleReader:
+    """ Lazily iterates the records of a bundle, either all of them or one block at a time using the manifest """
+
+    def __init__(self, path):
+        self.path = path
+        self._manifest = None
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            with open(f"{self.path}{MANIFEST_SUFFIX}") as f:
+                self._manifest = json.load(f)
+        return self._manifest
+
+    def __iter__(self):
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def __len__(self):
+        return self.manifest["records"]
+
+    def read_block(self, index):
+        """ Records of one block, read by seeking to it without decompressing the blocks before it """
+        block = self.manifest["blocks"][index]
+        with open(self.path, "rb") as f:
+            f.seek(block["offset"])
+            data = zlib.decompress(f.read(block["length"]), wbits=zlib.MAX_WBITS | 16)
+        return [json.loads(x) for x in data.decode("utf-8").splitlines() if x.strip()]
+
+    def get(self, kind, event_id):
+        """ Look up the record of one race through the manifest """
+        for entry in self.manifest["entries"]:
+            if entry["kind"] == kind and entry["event_id"] == str(event_id):
+                return self.read_block(entry["block"])[entry["line"]]
+        return None
+
+
+def iter_bundle(path):
+    """ Iterate every record in a bundle lazily """
+    return iter(BundleReader(path))
+
+
+def add_bundle_arguments(parser):
+    parser.add_argument("--bundle", action="store", dest="bundle", default=None,
+                        help="Write all races to this gzip-compressed NDJSON bundle instead of one file per race")
+    parser.add_argument("--bundle-block-size", action="store", dest="bundle_block_size", type=int, default=100,
+                        help="Number of records per compressed block in the bundle (defaults to 100)")
+
+
+def bundle_from_args(args):
+    return BundleWriter(args.bundle, block_size=args.bundle_block_size) if args.bundle is not None else None
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import date, datetime, timezone
+from logzero import logger
+
+
+def parse_start_time(start_time):
+    """ Seconds since the epoch of an ISO 8601 `startTime`, e.g. "2020-09-27T11:00:00Z" """
+    return datetime.fromisoformat(start_time.replace("Z", "+00:00")).timestamp()
+
+
+def record_hash(record):
+    """ Stable hash of a normalized output record """
+    return hashlib.sha256(json.dumps(record, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class ChangeTracker:
+    """ Remembers a content hash of each race's output record between runs, keyed by kind (upcoming/resulted) and
+    event id, so that only races that are new or have changed are written out.
+
+    A race's output goes through `changed`, and once its file has been written, `commit` stores its hash. A race
+    whose write failed is therefore written again by the next run.
+
+    Every event id found in an event list is registered with `seen` under its job scope (upcoming/resulted, race
+    type, day offset), with its start time and the day it was listed. At `finish`, races that were last seen in
+    one of this run's scopes but are no longer listed are dropped from the state. They are only reported as removed
+    when they should still have been listed: an upcoming race that has not started yet (the lists leave out
+    started races), or a result that was listed earlier the same day (before its day offset moved on). Races that
+    failed to import this run are still listed, so they are not removed. """
+
+    def __init__(self, state_file):
+        self.state_file = state_file
+        try:
+            with open(state_file) as f:
+                self.state = json.load(f)
+        except (OSError, ValueError):
+            self.state = {}
+        self.scopes = set()
+        self.listed = set()
+        self.manifest = {"created": [], "changed": [], "removed": [], "unchanged": 0}
+        self.lock = threading.Lock()  # `commit` is called from the file writer thread
+
+    @staticmethod
+    def scope(kind, race_type, offset_days):
+        return f"{kind}:{race_type}:{offset_days}"
+
+    @staticmethod
+    def key(kind, event_id):
+        return f"{kind}:{event_id}"
+
+    def seen(self, kind, race_type, offset_days, event_ids, starts=None):
+        """ Register the races of one job's event list. `starts` maps event ids to their `startTime`. """
+        scope = self.scope(kind, race_type, offset_days)
+        starts = starts or {}
+        with self.lock:
+            self.scopes.add(scope)
+            for event_id in event_ids:
+                key = self.key(kind, event_id)
+                self.listed.add(key)
+                entry = self.state.setdefault(key, {"hash": None, "filename": None})
+                entry["scope"] = scope
+                entry["start"] = starts.get(event_id, entry.get("start"))
+                entry["listed"] = date.today().isoformat()
+
+    def changed(self, kind, event_id, record, filename):
+        """ Whether a race's output is new or has changed since it was last written, and so should be written """
+        with self.lock:
+            entry = self.state.get(self.key(kind, event_id), {})
+            if entry.get("hash") == record_hash(record) and entry.get("filename") == filename:
+                self.manifest["unchanged"] += 1
+                return False
+            return True
+
+    def commit(self, kind, event_id, record, filename):
+        """ Store the output of a race once its file has been written """
+        with self.lock:
+            entry = self.state.setdefault(self.key(kind, event_id), {"scope": None, "hash": None, "filename": None})
+            change = {"kind": kind, "event_id": str(event_id), "filename": os.path.basename(filename)}
+            self.manifest["changed" if entry["hash"] is not None else "created"].append(change)
+            entry["hash"] = record_hash(record)
+            entry["filename"] = filename
+
+    @staticmethod
+    def expected(kind, entry):
+        """ Whether a race that is no longer listed should still have been """
+        if kind == "upcoming":
+            return entry.get("start") is not None and parse_start_time(entry["start"]) > time.time()
+        return entry.get("listed") == date.today().isoformat()
+
+    def save(self):
+        """ Write the state file, replaced atomically so that an interrupted save keeps the previous one """
+        temp_file = f"{self.state_file}.tmp"
+        with self.lock, open(temp_file, "w") as f:
+            json.dump(self.state, f)
+        os.replace(temp_file, self.state_file)
+
+    def finish(self, manifest_file=None):
+        """ Work out which races were removed, save the state file and write the manifest of this run """
+        for key, entry in list(self.state.items()):
+            if entry["scope"] in self.scopes and key not in self.listed:
+                kind, event_id = key.split(":", 1)
+                if entry["filename"] is not None and self.expected(kind, entry):
+                    self.manifest["removed"].append({"kind": kind, "event_id": event_id,
+                                                     "filename": os.path.basename(entry["filename"])})
+                del self.state[key]
+        self.save()
+        self.manifest["generated"] = datetime.now(timezone.utc).isoformat()
+        logger.info(f"{len(self.manifest['created'])} races created, {len(self.manifest['changed'])} changed, "
+                    f"{len(self.manifest['removed'])} removed and {self.manifest['unchanged']} unchanged")
+        if manifest_file is not None:
+            with open(manifest_file, "w") as f:
+                json.dump(self.manifest, f, indent=4)
+        return self.manifest
+
+
+def add_change_arguments(parser):
+    parser.add_argument("--state-file", action="store", dest="state_file", default=None,
+                        help="Keep hashes of the output in this file and only write races that are new or changed")
+    parser.add_argument("--manifest", action="store", dest="manifest", default=None,
+                        help="Write a manifest of created, changed and removed races to this file "
+                             "(requires --state-file)")
+
+
+def tracker_from_args(args):
+    return ChangeTracker(args.state_file) if args.state_file is not None else None
@@ -1,7 +1,27 @@
+import collections
+import io
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import random
 import requests
-from logzero import logger
+from logzero import logger, loglevel
 import sys
-from copy import deepcopy
+from fetch_profiles import FetchProfile
+from http_cache import ResponseCache
+from metrics import METRICS
+from replay import Recorder
+from source_archive import SourceArchive, CODECS
+try:
+    import ijson
+    from ijson.common import ObjectBuilder
+except ImportError:
+    ijson = None
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 COMMON_HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:80.0) Gecko/20100101 Firefox/80.0",
@@ -15,48 +35,743 @@ COMMON_HEADERS = {
     "Connection": "keep-alive"
 }
 
+API_BASE_URL = "https://content.tab.co.nz"
+HOMEPAGE_URL = "https://www.tab.co.nz/"
+COOKIE_FILE = "/tmp/tab-cookies.json"
+SESSION_COOKIE_TTL = 60 * 60  # Seconds to reuse a cookie that the homepage sent without an expiry
+
 RACE_TYPES = {
     "HORSE_RACING": "Thoroughbred",
     "HARNESS_RACING": "Harness",
     "GREYHOUNDS": "Greyhound"
 }
 
+LOCATIONS = ["New Zealand", "Australia"]
+
+# Seconds that a cached response stays fresh, by endpoint. Resulted events that have settled are kept for longer
+# (see get_resulted.RESULTED_SETTLED_TTL); endpoints that are not listed are never cached.
+CACHE_TTLS = {
+    "event-list": 60,
+    "events-by-ids": 60,
+    "resulted-event-list": 120,
+    "resulted-events": 300
+}
 
-def get_cloudfare_cookie():
-    """ Cloudfare uses cookies to identify users. Get a new cookie for each run of the script
-    to emulate human behavior. """
-    resp = requests.get("https://www.tab.co.nz/")
-    return resp.cookies["__cfduid"]
+# Responses worth retrying, and the ones that mean the server wants us to slow down
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+CONGESTION_STATUSES = {429, 503}
+# Responses that mean we are being blocked rather than the server struggling
+BLOCKED_STATUSES = {403, 429}
 
+# Fields of an event list entry used to pick and schedule events, for streaming parsing
+EVENT_LIST_FIELDS = ["id", "class.name", "category.code", "startTime"]
 
-def map_data(source_data, mapping):
-    def find(element, json):
-        keys = element.split('.')
+
+@METRICS.timed("cookie")
+def get_cloudfare_cookies(session):
+    """ Cloudfare uses cookies to identify users. Visit the homepage on `session` to be given new ones, as a browser
+    would. Only the headers are needed, so the page itself is not downloaded. """
+    session.get(HOMEPAGE_URL, stream=True).close()
+    return session.cookies
+
+
+class CookieStore:
+    """ The homepage cookies, saved to a JSON file with their expiry so that every script and run reuses them until
+    they expire, instead of visiting the homepage each time """
+
+    def __init__(self, filename=COOKIE_FILE):
+        self.filename = filename
+
+    def load(self):
+        """ {name: value} of the saved cookies, or None if the homepage has not been visited yet or one of the
+        cookies has expired. A visit that set no cookies counts for SESSION_COOKIE_TTL seconds, so it is not
+        repeated by every script. """
+        try:
+            with open(self.filename) as f:
+                saved = json.load(f)
+            expires = min([x["expires"] for x in saved["cookies"]] or [saved["fetched"] + SESSION_COOKIE_TTL])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        if expires <= time.time():
+            return None
+        return {x["name"]: x["value"] for x in saved["cookies"]}
+
+    def save(self, cookies):
+        """ Save a cookie jar and when it was fetched, giving cookies without an expiry SESSION_COOKIE_TTL
+        seconds """
+        now = time.time()
+        saved = {"fetched": now, "cookies": [{"name": x.name, "value": x.value,
+                                              "expires": x.expires or now + SESSION_COOKIE_TTL} for x in cookies]}
+        temp_filename = f"{self.filename}.{os.getpid()}.tmp"
+        with open(os.open(temp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+            json.dump(saved, f)
+        os.replace(temp_filename, self.filename)
+
+
+def event_matches(event, locations, race_type=None):
+    """ Whether an event list entry is in one of `locations` and, if given, of the given race type """
+    return ("class" in event and "name" in event["class"]
+            and event["class"]["name"] in locations
+            and "category" in event and "code" in event["category"]
+            and (race_type is None or event["category"]["code"] == race_type))
+
+
+def event_race_type(event, default="HORSE_RACING"):
+    """ Race type of an event from its category code, or `default` if that is not one of RACE_TYPES """
+    race_type = event.get("category", {}).get("code")
+    return race_type if race_type in RACE_TYPES else default
+
+
+def filter_events(events, locations, race_type):
+    """ Keep the events from an event list that are in one of `locations` and of the given race type """
+    return [x for x in events if event_matches(x, locations, race_type)]
+
+
+def stream_json_items(fileobj, prefix, fields=None, predicate=None):
+    """ Incrementally parse a JSON document and yield each element of the array at the dot-notated `prefix`
+    (e.g. "data.events") as soon as it has been read, without building the rest of the document.
+
+    `fields` limits each element to the given dot-notated subtrees (list indexes may be written as integers or
+    as "item" for every element); everything else is skipped while reading. Elements for which `predicate`
+    returns False are dropped. Requires the optional `ijson` package. """
+    if ijson is None:
+        raise RuntimeError("Streaming JSON parsing requires the ijson package")
+    item_prefix = f"{prefix}.item"
+    relative_start = len(item_prefix) + 1
+    keep = {}
+    if fields is not None:
+        fields = {".".join("item" if x.isdigit() else x for x in field.split(".")) for field in fields}
+        ancestors = {".".join(field.split(".")[:i]) for field in fields for i in range(1, field.count(".") + 1)}
+
+    def kept(path):
+        if path not in keep:
+            relative = path[relative_start:]
+            parts = relative.split(".")
+            keep[path] = (path == item_prefix or relative in ancestors
+                          or any(".".join(parts[:i]) in fields for i in range(1, len(parts) + 1)))
+        return keep[path]
+
+    builder = None
+    for path, event, value in ijson.parse(fileobj, use_float=True):
+        if builder is None:
+            if path == item_prefix and event in ("start_map", "start_array"):
+                builder = ObjectBuilder()
+                builder.event(event, value)
+            elif path == item_prefix:
+                if predicate is None or predicate(value):
+                    yield value
+            continue
+        if path == item_prefix and event in ("end_map", "end_array"):
+            builder.event(event, value)
+            item = builder.value
+            builder = None
+            if predicate is None or predicate(item):
+                yield item
+        elif fields is None or kept(path):
+            builder.event(event, value)
+
+
+def chunked(items, size):
+    """ Split a list into consecutive chunks of at most `size` items """
+    size = max(int(size), 1)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class RateLimiter:
+    """ Token bucket shared by every fetch thread. Politeness is expressed as requests per second rather than
+    a sleep after each request; `burst` is how many requests may go out back-to-back after an idle period. """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.capacity = max(float(burst), 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class AIMDController:
+    """ Limits the requests in flight with additive increase, multiplicative decrease. The limit grows by about one
+    per round of successful requests, up to `maximum`, and halves (at most once per round trip) on a 429/503, a
+    failed request or a latency well above the best seen so far. The rate of the `limiter` is halved along with it
+    and grows back to its configured rate in the same way. """
+
+    def __init__(self, initial, maximum, limiter=None, latency_factor=3.0):
+        self.maximum = max(int(maximum), 1)
+        self.limit = float(min(max(int(initial), 1), self.maximum))
+        self.in_flight = 0
+        self.limiter = limiter
+        self.max_rate = limiter.rate if limiter is not None else 0
+        self.latency_factor = latency_factor
+        self.latency = None  # Smoothed latency of successful requests
+        self.best_latency = None
+        self.decreased = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency=None, congested=False):
+        with self.condition:
+            self.in_flight -= 1
+            if latency is not None and not congested:
+                self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+                self.best_latency = min(self.best_latency or self.latency, self.latency)
+                congested = self.latency > self.best_latency * self.latency_factor
+            if congested:
+                self.decrease()
+            else:
+                self.increase()
+            self.condition.notify_all()
+
+    def increase(self):
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        if self.limiter is not None and 0 < self.limiter.rate < self.max_rate:
+            self.limiter.rate = min(self.max_rate, self.limiter.rate + self.max_rate / (10 * self.limit))
+
+    def decrease(self):
+        now = time.monotonic()
+        if now - self.decreased < (self.latency or 1.0):
+            return
+        self.decreased = now
+        self.limit = max(1.0, self.limit / 2)
+        if self.limiter is not None and self.limiter.rate > 0:
+            self.limiter.rate = max(self.max_rate / 16, self.limiter.rate / 2)
+        METRICS.count("backoffs")
+        logger.info(f"Backing off to {int(self.limit)} requests in flight")
+
+
+class CircuitBreaker:
+    """ Pauses every request once `threshold` requests in a row have been blocked (403, 429 or a Cloudfare
+    challenge page), for `cooldown` seconds, doubling up to `max_cooldown` while the blocking goes on """
+
+    def __init__(self, threshold=5, cooldown=60, max_cooldown=15 * 60):
+        self.threshold = threshold
+        self.initial_cooldown = cooldown
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.failures = 0
+        self.open_until = 0
+        self.lock = threading.Lock()
+
+    def wait(self, deadline):
+        """ Block while the breaker is open. Raises if it stays open past `deadline`. """
+        with self.lock:
+            open_until = self.open_until
+        if open_until > deadline:
+            raise RuntimeError(f"Upstream is blocking requests, paused for another "
+                               f"{open_until - time.monotonic():.0f}s")
+        if open_until > time.monotonic():
+            time.sleep(open_until - time.monotonic())
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.cooldown = self.initial_cooldown
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold and self.open_until <= time.monotonic():
+                self.open_until = time.monotonic() + self.cooldown
+                logger.warning(f"{self.failures} requests in a row were blocked, pausing for {self.cooldown}s")
+                METRICS.count("pauses")
+                self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+
+
+def is_blocked(response):
+    """ Whether a response is a refusal (403/429) or a Cloudfare challenge page instead of API data """
+    return response.status_code in BLOCKED_STATUSES or "text/html" in response.headers.get("Content-Type", "")
+
+
+def backoff_delay(attempt, base=0.5, cap=30.0, retry_after=None):
+    """ Full-jitter exponential backoff, at least as long as the server's Retry-After (in seconds) """
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    try:
+        return max(delay, float(retry_after)) if retry_after is not None else delay
+    except ValueError:
+        return delay
+
+
+class Fetcher:
+    """ One pooled keep-alive session for the whole run, with bounded concurrency, a global rate limit and an
+    optional on-disk response cache. `base_url` sends API requests to another host (e.g. a replay server), a
+    `recorder` captures every response the run uses, an `archive` keeps the raw event responses and a `profile`
+    (see fetch_profiles.FetchProfile) turns off the include flags that the mappings do not need.
+
+    Requests in flight start at `concurrency` and adapt between 1 and `max_concurrency` (see AIMDController).
+    Connection errors, 429s, 5xxs and challenge pages are retried with jittered exponential backoff, up to
+    `retries` times and for at most `deadline` seconds per request, and the CircuitBreaker pauses every request
+    while the upstream is blocking us. """
+
+    def __init__(self, cookies=None, rate=2.0, concurrency=4, cache=None, base_url=None, recorder=None,
+                 archive=None, max_concurrency=None, retries=5, deadline=120.0, profile=None):
+        self.concurrency = max(int(concurrency), 1)
+        self.max_concurrency = max(int(max_concurrency or self.concurrency), self.concurrency)
+        self.limiter = RateLimiter(rate)
+        self.controller = AIMDController(self.concurrency, self.max_concurrency, self.limiter)
+        self.breaker = CircuitBreaker()
+        self.retries = retries
+        self.deadline = deadline
+        self.cache = cache
+        self.base_url = base_url
+        self.recorder = recorder
+        self.archive = archive
+        self.profile = profile
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.max_concurrency,
+                                                pool_maxsize=self.max_concurrency)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update(COMMON_HEADERS)
+        for name, value in (cookies or {}).items():
+            self.session.cookies.set(name, value)
+        self.request_count = 0
+        self.bytes_received = 0
+        self.started = time.monotonic()
+        self.count_lock = threading.Lock()
+
+    def request(self, url, stream=False, headers=None):
+        """ GET a URL, retrying failures until `retries` or the deadline runs out. The last failed response is
+        returned (or the last connection error raised) so that callers see what went wrong. """
+        if self.base_url is not None and url.startswith(API_BASE_URL):
+            url = self.base_url.rstrip("/") + url[len(API_BASE_URL):]
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            self.breaker.wait(deadline)
+            response, error = self.attempt(url, stream, headers)
+            if error is None and response.status_code not in RETRY_STATUSES and not is_blocked(response):
+                self.breaker.success()
+                return response
+            if error is not None or is_blocked(response):
+                self.breaker.failure()
+            retry_after = response.headers.get("Retry-After") if response is not None else None
+            delay = backoff_delay(attempt, retry_after=retry_after)
+            if attempt >= self.retries or time.monotonic() + delay > deadline:
+                logger.error(f"Giving up on {url} after {attempt + 1} attempts: "
+                             f"{error if error is not None else f'HTTP {response.status_code}'}")
+                if error is not None:
+                    raise error
+                return response
+            logger.warning(f"Retrying {url} in {delay:.1f}s after "
+                           f"{error if error is not None else f'HTTP {response.status_code}'}")
+            METRICS.count("retries")
+            if response is not None:
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def attempt(self, url, stream=False, headers=None):
+        """ Make one request within the concurrency and rate limits. Returns (response, connection error). """
+        self.controller.acquire()
+        try:
+            self.limiter.acquire()  # Be a good citizen - avoid throttling by limiting request frequency
+            started = time.monotonic()
+            with METRICS.stage("http"):
+                response = self.session.get(url=url, stream=stream, headers=headers)
+                received = int(response.headers.get("Content-Length", 0)) if stream else len(response.content)
+        except requests.RequestException as e:
+            self.controller.release(congested=True)
+            METRICS.count("errors")
+            return None, e
+        self.controller.release(time.monotonic() - started,
+                                congested=response.status_code in CONGESTION_STATUSES or is_blocked(response))
+        with self.count_lock:
+            self.request_count += 1
+            self.bytes_received += received
+        METRICS.count("requests")
+        METRICS.count("bytes_received", received)
+        return response, None
+
+    def get(self, url, stream=False):
+        """ GET a URL on the shared session, or from the cache when it holds a fresh copy. With `stream`, the body
+        is left unread so that it can be parsed incrementally from `response.raw` (already decompressed). """
+        started = time.monotonic()
+        if self.profile is not None:
+            url = self.profile.apply(self, url)
+        archive = self.archive is not None and self.archive.archivable(url)
+        cached = self.cache is not None and self.cache.cacheable(url)
+        if cached:
+            response = self.cache.get(url, lambda headers: self.request(url, headers=headers))
+        else:
+            response = self.request(url, stream=stream and self.recorder is None and not archive)
+        if self.recorder is not None:
+            self.recorder.record(url, response.status_code, response.headers, response.content,
+                                 elapsed=time.monotonic() - started)
+        if archive and response.status_code == 200:
+            self.archive.store(url, response.content)
+        if self.recorder is not None or archive or (cached and stream):
+            response.raw = io.BytesIO(response.content)  # The body has been read, so stream it from memory
+        if stream:
+            response.raw.decode_content = True
+        return response
+
+    def use_cookies(self, store):
+        """ Send the cookies saved in a CookieStore, visiting the homepage for new ones if they have expired """
+        cookies = store.load()
+        if cookies is None:
+            get_cloudfare_cookies(self.session)
+            store.save(self.session.cookies)
+            logger.info(f"Saved new Cloudfare cookies to {store.filename}")
+            return
+        for name, value in cookies.items():
+            self.session.cookies.set(name, value)
+
+    def cache_url(self, url):
+        return url if self.profile is None else self.profile.apply(self, url)
+
+    def is_cached(self, url):
+        """ Whether the cache holds a fresh response for a URL """
+        return self.cache is not None and self.cache.cacheable(url) and self.cache.has_fresh(self.cache_url(url))
+
+    def cached(self, url):
+        """ Body of the fresh cached response for a URL, or None, without requesting it """
+        if self.cache is None or not self.cache.cacheable(url):
+            return None
+        return self.cache.fresh(self.cache_url(url))
+
+    def store(self, url, content, ttl):
+        """ Cache `content` as the response for a URL, fresh for `ttl` seconds, e.g. one event split out of a batch
+        response so that it is reused whichever batch it is asked for in """
+        if self.cache is not None and self.cache.cacheable(url):
+            self.cache.store(self.cache_url(url), content, {"Content-Type": "application/json"}, ttl=ttl)
+
+    def map(self, fn, items, ahead=None):
+        """ Apply `fn` to each item on the worker threads, yielding results in the order of `items`. At most `ahead`
+        items (twice `max_concurrency` by default) are started before their results are taken, so that a slow
+        consumer holds back the fetches instead of letting responses pile up in memory. """
+        ahead = ahead or 2 * self.max_concurrency
+        pending = collections.deque()
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as pool:
+            for item in items:
+                pending.append(pool.submit(fn, item))
+                if len(pending) >= ahead:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def log_stats(self):
+        elapsed = time.monotonic() - self.started
+        rate = self.request_count / elapsed if elapsed > 0 else 0.0
+        logger.info(f"Made {self.request_count} requests in {elapsed:.1f}s ({rate:.2f} requests/sec, "
+                    f"{self.bytes_received} bytes received)")
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.save()
+        self.session.close()
+
+
+def add_fetch_arguments(parser):
+    """ Command-line options shared by every script that fetches from the TAB API """
+    parser.add_argument("-b", "--batch-size", action="store", dest="batch_size", type=int, default=10,
+                        help="Number of events to request at once (defaults to 10, 1 requests each event separately)")
+    parser.add_argument("--rate", action="store", dest="rate", type=float, default=2.0,
+                        help="Maximum requests per second across all workers (defaults to 2)")
+    parser.add_argument("-c", "--concurrency", action="store", dest="concurrency", type=int, default=4,
+                        help="Number of requests in flight at once to start with (defaults to 4)")
+    parser.add_argument("--max-concurrency", action="store", dest="max_concurrency", type=int, default=16,
+                        help="Requests in flight may grow up to this while the server keeps up (defaults to 16)")
+    parser.add_argument("--retries", action="store", dest="retries", type=int, default=5,
+                        help="Times to retry a failed or throttled request (defaults to 5)")
+    parser.add_argument("--retry-deadline", action="store", dest="retry_deadline", type=float, default=120,
+                        help="Seconds to keep retrying a request for, including pauses (defaults to 120)")
+    parser.add_argument("-w", "--workers", action="store", dest="workers", type=int, default=0,
+                        help="Decode and map events in this many worker processes (defaults to 0, in this "
+                             "process; use with at least as much --concurrency)")
+    parser.add_argument("--stream", action="store_true", dest="stream", default=False,
+                        help="Parse responses incrementally, keeping only the fields that are used (requires ijson)")
+    parser.add_argument("--cache-dir", action="store", dest="cache_dir", default=None,
+                        help="Cache responses in this directory and reuse them across runs (off by default)")
+    parser.add_argument("--cache-size", action="store", dest="cache_size", type=int, default=500,
+                        help="Maximum size of the response cache in MB (defaults to 500)")
+    parser.add_argument("--cache-stats", action="store_true", dest="cache_stats", default=False,
+                        help="Print cache hit and miss counts at exit")
+    parser.add_argument("--record", action="store", dest="record", default=None,
+                        help="Record every HTTP exchange of the run to this directory, for replay.py")
+    parser.add_argument("--base-url", action="store", dest="base_url", default=None,
+                        help=f"Send API requests to this host instead of {API_BASE_URL}, e.g. a replay server "
+                             "(skips fetching the Cloudfare cookie)")
+    parser.add_argument("--cookie-file", action="store", dest="cookie_file", default=COOKIE_FILE,
+                        help=f"Keep the Cloudfare cookies in this file and reuse them until they expire, across "
+                             f"scripts and runs (defaults to {COOKIE_FILE})")
+    parser.add_argument("--source-archive", action="store", dest="source_archive", default=None,
+                        help="Keep the raw event responses, compressed and deduplicated, in this directory")
+    parser.add_argument("--source-archive-codec", action="store", dest="source_archive_codec", default="gzip",
+                        choices=sorted(CODECS), help="Compression of the source archive (defaults to gzip)")
+    parser.add_argument("--lean", action="store_true", dest="lean", default=False,
+                        help="Turn off the include flags whose data is not mapped, once a first request to each "
+                             "endpoint shows that the mapped records do not change")
+    parser.add_argument("--lean-report", action="store_true", dest="lean_report", default=False,
+                        help="Print the bytes saved by --lean on each endpoint at exit")
+
+
+def fetcher_from_args(args, fields=None, mappers=None):
+    """ Fetcher configured from the command line. `fields` ({endpoint name: field paths}) are what the script maps
+    from each endpoint and `mappers` ({endpoint name: function of an event}) how, for --lean. """
+    cache = None
+    if args.cache_dir is not None:
+        cache = ResponseCache(args.cache_dir, CACHE_TTLS, max_bytes=args.cache_size * 2 ** 20)
+    recorder = Recorder(args.record) if args.record is not None else None
+    archive = None
+    if args.source_archive is not None:
+        archive = SourceArchive(args.source_archive, codec=args.source_archive_codec)
+    profile = FetchProfile(fields, mappers) if args.lean and fields else None
+    fetcher = Fetcher(rate=args.rate, concurrency=args.concurrency, cache=cache, base_url=args.base_url,
+                      recorder=recorder, archive=archive, max_concurrency=args.max_concurrency,
+                      retries=args.retries, deadline=args.retry_deadline, profile=profile)
+    if args.base_url is None:
+        fetcher.use_cookies(CookieStore(args.cookie_file))
+    return fetcher
+
+
+def pool_from_args(args):
+    """ Process pool for decoding and mapping events, or None to do it in this process. Workers are started from a
+    fork server rather than forked from this process, since the first submit happens on a fetch thread while other
+    threads may hold locks (metrics, connection pools) that a forked child would inherit locked. The workers get
+    this process's log level, which they no longer inherit. """
+    if args.workers <= 0:
+        return None
+    return ProcessPoolExecutor(args.workers, mp_context=multiprocessing.get_context("forkserver"),
+                               initializer=loglevel, initargs=(logger.level,))
+
+
+def close_fetcher(fetcher, args):
+    """ Log request stats, report on the cache if asked to and release the session """
+    fetcher.log_stats()
+    if fetcher.archive is not None:
+        fetcher.archive.report()
+    if args.cache_stats and fetcher.cache is not None:
+        print(json.dumps(fetcher.cache.report(), indent=4))
+    if args.lean_report and fetcher.profile is not None:
+        print(json.dumps(fetcher.profile.report, indent=4))
+    fetcher.close()
+
+
+def fetch_batched(fetcher, fetch_events, event_ids, batch_size=1, retry_missing=True):
+    """ Fetch events in chunks of `batch_size` using the multi-ID `eventIds` parameter.
+
+    `fetch_events` takes a list of event ids and returns the list of source events in the response. Chunks are
+    fetched concurrently on the fetcher's workers. Events are matched back to their ids, and any chunk that fails
+    (or any id missing from the response) falls back to one request per event. Yields (event_id, source_event,
+    error, started) in the order of `event_ids`; exactly one of `source_event` and `error` is None so that callers
+    can keep per-event error handling, and `started` is the time.monotonic() at which the event's fetch began.
+
+    Without `retry_missing`, an id that a response left out is not requested again but yielded with both
+    `source_event` and `error` None, for endpoints that leave out events with nothing to report yet. """
+    def fetch_batch(batch):
+        started = time.monotonic()
+        found = None
+        if len(batch) > 1:
+            try:
+                found = {str(x["id"]): x for x in fetch_events(batch)}
+            except Exception as e:
+                logger.warning(f"Batch request for event ids {batch} failed, falling back to single requests: "
+                               f"{sys.exc_info()[0]}")
+                logger.debug(e)
+        results = []
+        for event_id in batch:
+            source_event = None if found is None else found.get(str(event_id))
+            if source_event is None and found is not None and not retry_missing:
+                results.append((event_id, None, None, started))
+                continue
+            if source_event is None:
+                if len(batch) > 1:
+                    METRICS.count("retries")
+                try:
+                    source_event = next((x for x in fetch_events([event_id]) if str(x["id"]) == str(event_id)),
+                                        None)
+                    if source_event is None and not retry_missing:
+                        results.append((event_id, None, None, started))
+                        continue
+                    if source_event is None:
+                        raise ValueError(f"Event id {event_id} not found in response")
+                except Exception as e:
+                    results.append((event_id, None, e, started))
+                    continue
+            results.append((event_id, source_event, None, started))
+        return results
+
+    for results in fetcher.map(fetch_batch, list(chunked(list(event_ids), batch_size))):
+        yield from results
+
+
+def write_json(data, filename):
+    """ Write data as indented JSON to a temporary file next to `filename`, then rename it into place, so that
+    nothing reading the output directory (such as the scp in update.sh) ever sees a half-written file """
+    temp_filename = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_filename, "w") as outfile:
+            json.dump(data, outfile, indent=4)
+        os.replace(temp_filename, filename)
+    except BaseException:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+
+
+class FileWriter:
+    """ Writes output files on a background thread, so that writing races overlaps with fetching and mapping the
+    next ones. Jobs go through a bounded queue: when the disk falls behind, `submit` blocks and the fetches wait
+    with it.
+
+    Each job is (write function, data, filename, started, callback). Once a file is written, the time since
+    `started` (when its fetch began) is added to the "latency" stage and passed to the callback. A failed write
+    is logged and counted as an error, and its callback is not called. Use as a context manager; leaving it waits
+    for every queued write. """
+
+    def __init__(self, size=32):
+        self.queue = queue.Queue(maxsize=size)
+        self.thread = threading.Thread(target=self.run, name="file-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, write_fn, data, filename, started, callback=None):
+        self.queue.put((write_fn, data, filename, started, callback))
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            write_fn, data, filename, started, callback = job
+            try:
+                write_fn(data, filename)
+                latency = time.monotonic() - started
+                METRICS.observe("latency", latency)
+                if callback is not None:
+                    callback(latency)
+            except Exception as e:
+                METRICS.count("errors")
+                logger.error(f"Error while writing file {filename}: {sys.exc_info()[0]}")
+                logger.exception(e)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+class EventIndex:
+    """ Dict lookups over one source event, built in a single pass so that processing an event is linear in its
+    size. Where the source has duplicates, the first match wins, as with a linear scan. """
+
+    def __init__(self, event_info):
+        self.event_info = event_info
+        self.id = event_info.get("id")
+        self.markets = {}
+        self.outcomes = {}
+        self.outcomes_by_name = {}
+        self.prices = {}
+        self.pools = {}
+        self.dividends = {}
+        for market in event_info.get("markets", []):
+            group_code = market.get("groupCode")
+            self.markets.setdefault(group_code, market)
+            for outcome in market.get("outcomes", []):
+                self.outcomes.setdefault(outcome.get("id"), outcome)
+                if self.markets[group_code] is market:
+                    self.outcomes_by_name.setdefault((group_code, outcome.get("name")), outcome)
+        for pool in event_info.get("pools", []):
+            self.pools.setdefault(pool.get("type"), pool)
+            if self.pools[pool.get("type")] is pool:
+                dividends = self.dividends[pool.get("type")] = {}
+                for dividend in pool.get("dividends", []):
+                    dividends.setdefault(dividend.get("type"), dividend)
+
+    def market(self, group_code):
+        return self.markets.get(group_code)
+
+    def outcome(self, outcome_id):
+        return self.outcomes.get(outcome_id)
+
+    def outcome_by_name(self, group_code, name):
+        return self.outcomes_by_name.get((group_code, name))
+
+    def price(self, outcome, price_type):
+        """ Price record of the given type for an outcome, or None """
+        key = id(outcome)
+        if key not in self.prices:
+            prices = self.prices[key] = {}
+            for price in outcome.get("prices", []):
+                prices.setdefault(price.get("priceType"), price)
+        return self.prices[key].get(price_type)
+
+    def pool(self, pool_type):
+        return self.pools.get(pool_type)
+
+    def dividend(self, pool_type, dividend_type):
+        return self.dividends.get(pool_type, {}).get(dividend_type)
+
+
+def compile_path(element):
+    """ Pre-split a dot-notated path into an accessor function, so that no string parsing happens per record """
+    steps = []
+    for key in element.split('.'):
+        try:
+            index = int(key)
+        except ValueError:
+            index = None
+        steps.append((key, index))
+    steps = tuple(steps)
+
+    def find(json):
         value = json
-        for key in keys:
+        for key, index in steps:
             if isinstance(value, dict):
-                if value is not None and key in value:
+                if key in value:
                     value = value[key]
                 else:
                     return None
             elif isinstance(value, list):
-                try:
-                    index = int(key)
-                except ValueError:
+                if index is None:
                     logger.warning(f"Attempted to retrieve non-integer key {key} from list")
-                    logger.debug(f"value: {value}")
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f"value: {value}")
                     return None
-                if len(value) >= index:
+                if -len(value) <= index < len(value):
                     value = value[index]
                 else:
                     logger.warning("Attempted to retrieve non-existent index")
-                    logger.debug(f"value: {value}")
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f"value: {value}")
                     return None
         return value
-    dest_data = deepcopy(mapping)
-    for key in dest_data:
-        dest_data[key] = find(mapping[key], source_data)
-    return dest_data
+    return find
+
+
+def compile_mapping(mapping):
+    """ Turn a data map into a single callable that builds the output dict for one source record """
+    accessors = tuple((key, compile_path(element)) for key, element in mapping.items())
+
+    def mapper(source_data):
+        return {key: find(source_data) for key, find in accessors}
+    return mapper
+
+
+def map_data(source_data, mapping):
+    return compile_mapping(mapping)(source_data)
 
 
 def format_data(data, format_rules):
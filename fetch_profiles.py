@@ -0,0 +1,122 @@
+""" Lean fetch profiles: API URLs with the include flags turned off whose subtrees no mapped field reads.
+
+Each script knows the fields it reads from each endpoint (the mappings, plus what `get_odds` / `get_prize` and the
+event selection use). An include flag is turned off when none of the subtrees it adds to an event overlaps one of
+those fields. The first request to each endpoint is made with both the full and the lean URL, and the endpoint only
+goes lean if the script's own mapper gives identical records for every event of both responses. Endpoints without a
+mapper (the event lists) compare the events' values at the fields instead. """
+import re
+import threading
+from logzero import logger
+from http_cache import endpoint_name
+
+# Subtrees that each include flag adds to every event of a response. Flags that are not listed here (e.g.
+# includeChildMarkets, which decides which markets there are rather than adding a subtree) are never changed.
+# includePriceHistory is left out until the layout of the price history it adds has been confirmed.
+INCLUDE_SUBTREES = {
+    "includeRace": ["race"],
+    "includeRunners": ["race.runners"],
+    "includeMedia": ["media"],
+    "includePools": ["pools"],
+    "includeRacingResults": ["result"]
+}
+INCLUDE_FLAG = re.compile(r"([?&])(include\w+)=true\b")
+
+
+def normalize_path(path):
+    """ Field path with list indexes replaced by "item", e.g. "legs.0.result" -> "legs.item.result" """
+    return ".".join("item" if x.isdigit() else x for x in path.split("."))
+
+
+def overlaps(path, field):
+    """ Whether a path is read by a field: it is the field, a part of it, or one of its parents """
+    return path == field or path.startswith(field + ".") or field.startswith(path + ".")
+
+
+def project(node, path):
+    """ Value of a JSON value at a normalized path, with "item" taking every element of a list, or None if missing """
+    if not path:
+        return node
+    key, _, rest = path.partition(".")
+    if key == "item":
+        return [project(x, rest) for x in node] if isinstance(node, list) else None
+    return project(node.get(key), rest) if isinstance(node, dict) else None
+
+
+def response_events(response_json):
+    """ Every event in a response, whatever key the events are listed under """
+    for events in response_json.get("data", {}).values():
+        if isinstance(events, list):
+            yield from events
+
+
+class FetchProfile:
+    """ Rewrites the URLs of the endpoints in `fields` ({endpoint name: field paths read from each event}) to
+    their lean form, once the first request to the endpoint has shown that the mapped records do not change.
+    `mappers` ({endpoint name: function of a source event}) are what the script makes of each event. """
+
+    def __init__(self, fields, mappers=None):
+        self.fields = {k: [normalize_path(x) for x in v] for k, v in fields.items()}
+        self.mappers = mappers or {}
+        self.report = {}  # endpoint: outcome of its check
+        self.lock = threading.Lock()
+
+    def map_event(self, endpoint, event):
+        if endpoint not in self.mappers:
+            return {x: project(event, x) for x in self.fields[endpoint]}
+        try:
+            return self.mappers[endpoint](event)
+        except Exception as e:
+            return f"{type(e).__name__}: {e}"
+
+    def records(self, endpoint, response_json):
+        return {str(x.get("id")): self.map_event(endpoint, x) for x in response_events(response_json)}
+
+    def unused_flags(self, url):
+        fields = self.fields[endpoint_name(url)]
+        return sorted(flag for _, flag in INCLUDE_FLAG.findall(url) if flag in INCLUDE_SUBTREES and
+                      not any(overlaps(x, y) for x in INCLUDE_SUBTREES[flag] for y in fields))
+
+    def lean_url(self, url):
+        unused = self.unused_flags(url)
+        return INCLUDE_FLAG.sub(lambda x: f"{x[1]}{x[2]}={'false' if x[2] in unused else 'true'}", url)
+
+    def check(self, fetcher, url, lean_url):
+        """ Fetch the full and the lean URL, map the events of both and compare the records """
+        endpoint = endpoint_name(url)
+        full = fetcher.request(url)
+        lean = fetcher.request(lean_url)
+        report = {"flags_off": self.unused_flags(url), "lean": False, "mismatched": []}
+        if full.status_code != 200 or lean.status_code != 200:
+            logger.error(f"Could not check the lean profile of {endpoint} (HTTP {full.status_code} for the full URL, "
+                         f"{lean.status_code} for the lean one), using the full URL")
+            return report
+        full_records = self.records(endpoint, full.json())
+        lean_records = self.records(endpoint, lean.json())
+        report["mismatched"] = sorted(x for x in full_records.keys() | lean_records.keys()
+                                      if full_records.get(x) != lean_records.get(x))
+        report["lean"] = not report["mismatched"]
+        report["full_bytes"] = len(full.content)
+        report["lean_bytes"] = len(lean.content)
+        report["saved_bytes"] = len(full.content) - len(lean.content)
+        report["saved_percent"] = round(100 * report["saved_bytes"] / max(len(full.content), 1), 1)
+        if report["mismatched"]:
+            logger.error(f"The lean profile of {endpoint} changes the records of event ids {report['mismatched']}, "
+                         f"using the full URL")
+        else:
+            logger.info(f"Lean profile of {endpoint}: {', '.join(report['flags_off'])} off, "
+                        f"{report['saved_bytes']} of {report['full_bytes']} bytes saved ({report['saved_percent']}%)")
+        return report
+
+    def apply(self, fetcher, url):
+        """ The URL to request instead of `url`, checking the endpoint's profile on its first request """
+        endpoint = endpoint_name(url)
+        if endpoint not in self.fields:
+            return url
+        lean_url = self.lean_url(url)
+        if lean_url == url:
+            return url
+        with self.lock:
+            if endpoint not in self.report:
+                self.report[endpoint] = self.check(fetcher, url, lean_url)
+        return lean_url if self.report[endpoint]["lean"] else url
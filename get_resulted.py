@@ -5,17 +5,22 @@ __license__ = "Proprietary"
 
 import argparse
 import json
+import logging
 import os
 import sys
-import time
-import requests
+from functools import partial
 from logzero import logger, loglevel, logfile
 try:
     from backports.datetime_fromisoformat import MonkeyPatch
     MonkeyPatch.patch_fromisoformat()
 except ImportError:
     pass
-from common import format_data, map_data, get_cloudfare_cookie, COMMON_HEADERS, RACE_TYPES
+from bundle import add_bundle_arguments, bundle_from_args
+from changes import add_change_arguments, tracker_from_args
+from common import (compile_mapping, format_data, EventIndex, fetch_batched, event_matches, stream_json_items,
+                    event_race_type, add_fetch_arguments, close_fetcher, fetcher_from_args, pool_from_args,
+                    EVENT_LIST_FIELDS, LOCATIONS, write_json, FileWriter, RACE_TYPES)
+from metrics import add_metrics_arguments, metrics_from_args, report_metrics, METRICS
 
 logfile("/tmp/get-resulted.log", maxBytes=int(1e6), backupCount=10)
 
@@ -58,72 +63,89 @@ RESULTED_RACE_EXOTIC_POOL_DIVIDEND_DATA_MAPPING = {
 RESULTED_RACE_EXOTIC_POOL_DIVIDEND_FORMATTING_RULES = {
     "prize": lambda x: POOL_CODES.get(x, x)
 }
+RESULTED_RACE_DATA_MAPPER = compile_mapping(RESULTED_RACE_DATA_MAPPING)
+RESULTED_RACE_PRIZES_DATA_MAPPER = compile_mapping(RESULTED_RACE_PRIZES_DATA_MAPPING)
+RESULTED_RACE_EXOTIC_POOL_DIVIDEND_DATA_MAPPER = compile_mapping(RESULTED_RACE_EXOTIC_POOL_DIVIDEND_DATA_MAPPING)
+RESULTED_EVENT_FIELDS = list(RESULTED_RACE_DATA_MAPPING.values()) + [
+    "result.finalPositions",
+    "pools",
+    "markets.item.groupCode",
+    "markets.item.outcomes"
+]
+RESULTED_SETTLED_TTL = 7 * 24 * 60 * 60  # Seconds to keep a settled event cached on its own
 RESULTED_EVENT_URL = "https://content.tab.co.nz/content-service/api/v1/q/resulted-events?eventIds={event_ids}&includeChildMarkets=true&includePools=true&includeRace=true&includeRunners=true"
 RESULTED_EVENT_LIST_URL = "https://content.tab.co.nz/content-service/api/v1/q/resulted-event-list?drilldownTagIds=18%2C19%2C38&relativeMeetingOffsetDays=-{offset_days}&includePools=true&includeRacingResults=true&includeRace=true"
+# Fields read from each endpoint, for lean fetch profiles (--lean)
+RESULTED_PROFILE_FIELDS = {"resulted-event-list": EVENT_LIST_FIELDS, "resulted-events": RESULTED_EVENT_FIELDS}
 
 
-def get_resulted_event_list(cloudfare_cookie, locations=None, offset_days=0, race_type="HORSE_RACING"):
+@METRICS.timed("list_fetch")
+def fetch_resulted_event_list(fetcher, offset_days=0, stream=False, predicate=None):
+    """ Fetch the whole resulted event list for a day, across every location and race type. With `stream`, the
+    list is parsed incrementally and only the fields needed to select events are kept. """
+    url = RESULTED_EVENT_LIST_URL.format(offset_days=offset_days)
+    if stream:
+        with fetcher.get(url=url, stream=True) as event_list, METRICS.stage("decode"):
+            return list(stream_json_items(event_list.raw, "data.eventResults", fields=EVENT_LIST_FIELDS,
+                                          predicate=predicate))
+    event_list = fetcher.get(url=url)
+    with METRICS.stage("decode"):
+        event_list_json = event_list.json()
+    events = event_list_json['data']['eventResults']
+    return events if predicate is None else [x for x in events if predicate(x)]
+
+
+def get_resulted_event_list(fetcher, locations=None, offset_days=0, race_type="HORSE_RACING", stream=False):
     if locations is None:
         logger.warning('get_resulted_event_list: No locations specified. Event list will return no results.')
         locations = []
-    event_list = requests.get(url=RESULTED_EVENT_LIST_URL.format(offset_days=offset_days),
-                              headers=COMMON_HEADERS.update({'__cfduid': cloudfare_cookie}))
-    event_list_json = event_list.json()
-    events = event_list_json['data']['eventResults']
-    return [x for x in events if "class" in x and "name" in x["class"]
-            and x["class"]["name"] in locations
-            and "category" in x and "code" in x["category"]
-            and x["category"]["code"] == race_type]
-
-
-def dereference_outcomes(event_info):
-    def get_outcome(event_info, outcome_id):
-        for market in event_info["markets"]:
-            outcome = next((x for x in market["outcomes"] if x["id"] == outcome_id), None)
-            if outcome:
-                return outcome
-        return None
-    for pool in event_info["pools"]:
+    return fetch_resulted_event_list(fetcher, offset_days, stream=stream,
+                                     predicate=partial(event_matches, locations=locations, race_type=race_type))
+
+
+def dereference_outcomes(event_index):
+    for pool in event_index.event_info["pools"]:
         for dividend in pool.get("dividends", []):
             for leg in dividend.get("legs"):
                 for i, outcome in enumerate(leg["outcomes"]):
-                    leg["outcomes"][i] = get_outcome(event_info, outcome["id"])
+                    leg["outcomes"][i] = event_index.outcome(outcome["id"])
 
 
-def get_prize(event_info, position):
+def get_prize(event_index, position):
     win_price = ""
     place_price = ""
     if position == 1:
-        win_pool = next((x for x in event_info["pools"] if x["type"] == "WIN"), None)
+        win_pool = event_index.pool("WIN")
         if win_pool is None:
-            logger.warning(f"No 'WIN' pool found, cannot return WIN prizes for event id {event_info['id']}")
-        win_dividend = next((x for x in win_pool["dividends"] if x["type"] == "WIN"), None)
+            logger.warning(f"No 'WIN' pool found, cannot return WIN prizes for event id {event_index.id}")
+        win_dividend = event_index.dividend("WIN", "WIN")
         if win_dividend is None:
             logger.warning(f"No 'WIN' dividend found in WIN pool, cannot return WIN prizes "
-                           f"for event id {event_info['id']}")
-        prices = win_dividend["legs"][0]["outcomes"][0]["prices"]
-        logger.debug(json.dumps(win_dividend, indent=4))
-        logger.debug(json.dumps(prices, indent=4))
-        win_price_record = next((x for x in prices if x["priceType"] == "WIN_POOL"), None)
+                           f"for event id {event_index.id}")
+        outcome = win_dividend["legs"][0]["outcomes"][0]
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(json.dumps(win_dividend, indent=4))
+            logger.debug(json.dumps(outcome["prices"], indent=4))
+        win_price_record = event_index.price(outcome, "WIN_POOL")
         if win_price_record is not None:
             win_price = win_price_record["decimal"]
-        place_price_record = next((x for x in prices if x["priceType"] == "PLACE_POOL"), None)
+        place_price_record = event_index.price(outcome, "PLACE_POOL")
         if place_price_record is not None:
             place_price = place_price_record["decimal"]
     else:
-        place_pool = next((x for x in event_info["pools"] if x["type"] == "PLC"), None)
+        place_pool = event_index.pool("PLC")
         if place_pool is None:
-            logger.warning(f"No 'PLC' pool found, cannot return PLC prizes for event id {event_info['id']}")
+            logger.warning(f"No 'PLC' pool found, cannot return PLC prizes for event id {event_index.id}")
         for dividend in place_pool["dividends"]:
             outcomes = dividend["legs"][0]["outcomes"]
             outcome = next((x for x in outcomes if x["result"]["position"] == position), None)
             if outcome is not None:
-                place_price_record = next((x for x in outcome["prices"] if x["priceType"] == "PLACE_POOL"), None)
+                place_price_record = event_index.price(outcome, "PLACE_POOL")
                 if place_price_record is not None:
                     place_price = place_price_record["decimal"]
                 else:
                     logger.warning(f"Found place outcome, but not place price for position {position} "
-                                   f"in event {event_info['id']}")
+                                   f"in event {event_index.id}")
             else:
                 logger.debug(f"Did not find place outcome for position {position}")
     return {
@@ -132,15 +154,16 @@ def get_prize(event_info, position):
     }
 
 
-def get_top_positions(event_info):
+@METRICS.timed("prizes")
+def get_top_positions(event_index):
     try:
-        final_positions = event_info['result']['finalPositions']
+        final_positions = event_index.event_info['result']['finalPositions']
     except KeyError:
         logger.error("Cannot find result and finalPositions")
         return []
-    records = [format_data(map_data(x, RESULTED_RACE_PRIZES_DATA_MAPPING), RESULTED_RACE_PRIZES_FORMATTING_RULES) for
+    records = [format_data(RESULTED_RACE_PRIZES_DATA_MAPPER(x), RESULTED_RACE_PRIZES_FORMATTING_RULES) for
                x in sorted(final_positions, key=lambda x: x["position"])]
-    [x.update(get_prize(event_info, i+1)) for i, x in enumerate(records)]
+    [x.update(get_prize(event_index, i+1)) for i, x in enumerate(records)]
     return records
 
 
@@ -151,59 +174,241 @@ def get_exotics(event_info):
         dividends = pool.get("dividends", [])
         if len(dividends) > 0:
             dividend = dividends[0]
-            record = map_data(dividend, RESULTED_RACE_EXOTIC_POOL_DIVIDEND_DATA_MAPPING)
+            record = RESULTED_RACE_EXOTIC_POOL_DIVIDEND_DATA_MAPPER(dividend)
             record = format_data(record, RESULTED_RACE_EXOTIC_POOL_DIVIDEND_FORMATTING_RULES)
             records.append(record)
     return records
 
 
-def get_resulted_event(cloudfare_cookie, event_id, save_source=False, output_dir=".", race_type="HORSE_RACING"):
-    event_info = requests.get(url=RESULTED_EVENT_URL.format(event_ids=event_id),
-                              headers=COMMON_HEADERS.update({'__cfduid': cloudfare_cookie})).json()
-    logger.debug(json.dumps(event_info, indent=4))
+def is_settled(event_info):
+    """ A resulted event has settled once it has final positions and a paying WIN pool, after which the output
+    for it no longer changes """
+    return (bool(event_info.get("result", {}).get("finalPositions"))
+            and any(x.get("type") == "WIN" and x.get("dividends") for x in event_info.get("pools", [])))
+
+
+def resulted_events_url(event_ids):
+    return RESULTED_EVENT_URL.format(event_ids=",".join(str(x) for x in event_ids))
+
+
+def settled_source(event):
+    """ Body of a resulted-events response for one settled event, to cache on its own """
+    return json.dumps({"data": {"eventResults": [event]}}).encode("utf-8")
+
+
+def cached_resulted_events(fetcher, event_ids):
+    """ Split event ids into the bodies cached for each on its own ({event_id: body}) and the ids to request """
+    cached = {}
+    for event_id in event_ids:
+        content = fetcher.cached(resulted_events_url([event_id]))
+        if content is not None:
+            cached[event_id] = content
+    return cached, [x for x in event_ids if x not in cached]
+
+
+@METRICS.timed("detail_fetch")
+def fetch_resulted_events(fetcher, event_ids, save_source=False, output_dir=".", stream=False):
+    """ Fetch the source data for one or more resulted events in a single request. With `stream` (and no source
+    data to save), events are parsed incrementally and only the fields used by the data maps and prizes are
+    kept.
+
+    Settled events are cached on their own, under the URL of a request for just that event, so that they are
+    reused whichever batch they are asked for in; events that are cached that way are not requested again. Streamed
+    events are not cached on their own, since only some of their fields are kept. """
+    cached, event_ids = cached_resulted_events(fetcher, event_ids)
+    with METRICS.stage("decode"):
+        events = [x for content in cached.values() for x in json.loads(content)['data']['eventResults']]
+    if event_ids and stream and not save_source:
+        with fetcher.get(url=resulted_events_url(event_ids), stream=True) as response, METRICS.stage("decode"):
+            events += stream_json_items(response.raw, "data.eventResults", fields=RESULTED_EVENT_FIELDS)
+    elif event_ids:
+        response = fetcher.get(url=resulted_events_url(event_ids))
+        with METRICS.stage("decode"):
+            response = response.json()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(json.dumps(response, indent=4))
+        for event in response['data']['eventResults']:
+            if fetcher.cache is not None and is_settled(event):
+                fetcher.store(resulted_events_url([event['id']]), settled_source(event), RESULTED_SETTLED_TTL)
+            events.append(event)
     if save_source:
-        filename = os.path.join(output_dir, f"{event_id}-results.json")
-        with open(filename, "w") as debugfile:
-            json.dump(event_info, debugfile, indent=4)
-    event_info = event_info['data']['eventResults'][0]
-    dereference_outcomes(event_info)
-    mapped_event_info = map_data(event_info, mapping=RESULTED_RACE_DATA_MAPPING)
+        for event in events:
+            filename = os.path.join(output_dir, f"{event['id']}-results.json")
+            with open(filename, "w") as debugfile:
+                json.dump({"data": {"eventResults": [event]}}, debugfile, indent=4)
+    return events
+
+
+@METRICS.timed("map")
+def map_resulted_event(event_info, race_type="HORSE_RACING"):
+    event_index = EventIndex(event_info)
+    dereference_outcomes(event_index)
+    mapped_event_info = RESULTED_RACE_DATA_MAPPER(event_info)
     mapped_event_info['type'] = race_type
     format_data(mapped_event_info, RESULTED_RACE_FORMATTING_RULES)
-    mapped_event_info['groups'] = [{"name": "prizes", "records": get_top_positions(event_info)},
+    mapped_event_info['groups'] = [{"name": "prizes", "records": get_top_positions(event_index)},
                                    {"name": "exotics", "records": get_exotics(event_info)}]
     return mapped_event_info
 
 
+def map_profiled_resulted_event(event_info):
+    """ What an import takes from a resulted event, to check a lean fetch profile with: whether it has settled and
+    its record """
+    return is_settled(event_info), map_resulted_event(event_info, race_type=event_race_type(event_info))
+
+
+RESULTED_PROFILE_MAPPERS = {"resulted-events": map_profiled_resulted_event}
+
+
+def decode_resulted_events(content, event_race_types, save_source=False, output_dir=".", keep_settled=False):
+    """ Decode a resulted-events response and map each of its events, in a worker process. Only the small results
+    go back to the parent: one {"id", "record", "settled", "error"} per event, plus the `source` of each settled
+    event with `keep_settled`, for the parent to cache. """
+    results = []
+    for event in json.loads(content)['data']['eventResults']:
+        if str(event['id']) not in event_race_types:
+            continue
+        if save_source:
+            with open(os.path.join(output_dir, f"{event['id']}-results.json"), "w") as debugfile:
+                json.dump({"data": {"eventResults": [event]}}, debugfile, indent=4)
+        result = {"id": event['id'], "record": None, "settled": is_settled(event), "error": None}
+        if keep_settled and result["settled"]:
+            result["source"] = settled_source(event)
+        try:
+            result["record"] = map_resulted_event(event, race_type=event_race_types[str(event['id'])])
+        except Exception as e:
+            logger.exception(e)
+            result["error"] = f"{type(e).__name__}: {e}"
+        results.append(result)
+    return results
+
+
+def fetch_mapped_resulted_events(fetcher, pool, event_ids, event_race_types, save_source=False, output_dir="."):
+    """ Fetch one or more resulted events in a single request, then decode and map them on the process pool.
+    Settled events are cached on their own, as in `fetch_resulted_events`. """
+    race_types = {str(x): event_race_types[x] for x in event_ids}
+    cached, event_ids = cached_resulted_events(fetcher, event_ids)
+    futures = [pool.submit(decode_resulted_events, x, race_types, save_source, output_dir) for x in cached.values()]
+    if event_ids:
+        content = fetcher.get(url=resulted_events_url(event_ids)).content
+        futures.append(pool.submit(decode_resulted_events, content, race_types, save_source, output_dir,
+                                   fetcher.cache is not None))
+    with METRICS.stage("pool"):
+        results = [x for future in futures for x in future.result()]
+    for result in results:
+        source = result.pop("source", None)
+        if source is not None:
+            fetcher.store(resulted_events_url([result["id"]]), source, RESULTED_SETTLED_TTL)
+    return results
+
+
+def get_resulted_event(fetcher, event_id, save_source=False, output_dir=".", race_type="HORSE_RACING"):
+    event_info = fetch_resulted_events(fetcher, [event_id], save_source=save_source,
+                                       output_dir=output_dir)[0]
+    return map_resulted_event(event_info, race_type=race_type)
+
+
+def resulted_event_filename(event_info, output_dir="."):
+    filename = f"{event_info['type'].lower()}-results-{event_info['meeting number']}-"\
+               f"{event_info['meeting place'].replace(' ', '_')}-R{event_info['race number']}.json"
+    return os.path.join(output_dir, filename)
+
+
+@METRICS.timed("write")
+def write_resulted_event(event_info, filename):
+    write_json([event_info], filename)
+
+
+def import_resulted_events(fetcher, event_race_types, output_dir=".", save_source=False, batch_size=10,
+                           stream=False, tracker=None, bundle=None, pool=None):
+    """ Fetch, map and write out each resulted event. `event_race_types` maps each event id to its race type.
+    With a `tracker`, results whose output has not changed since the last run are not written. With a
+    `bundle`, records are added to it instead of being written to their own files. With a process `pool`,
+    responses are decoded and mapped on it; records are still written here, in the same order. Returns the ids of
+    the events that were imported, whether written or unchanged.
+
+    Fetching, mapping and writing overlap as in `get_upcoming.import_events`, with files written on a FileWriter
+    thread and renamed into place, and the time from the start of each fetch logged. """
+    # Results cached on their own are taken first, so that the batches of the others do not depend on them
+    event_ids = sorted(event_race_types, key=lambda x: not fetcher.is_cached(resulted_events_url([x])))
+    imported = []
+
+    def written(i, event_id, event_info, filename, latency):
+        if tracker is not None:
+            tracker.commit("resulted", event_id, event_info, filename)
+        METRICS.count("written")
+        imported.append(event_id)
+        logger.info(f"Result {i + 1} of {len(event_ids)}. Wrote file {filename} {latency:.2f}s after fetching it.")
+
+    if pool is not None:
+        fetch_events = partial(fetch_mapped_resulted_events, fetcher, pool, event_race_types=event_race_types,
+                               save_source=save_source, output_dir=output_dir)
+    else:
+        fetch_events = partial(fetch_resulted_events, fetcher, save_source=save_source, output_dir=output_dir,
+                               stream=stream)
+    results = fetch_batched(fetcher, fetch_events, event_ids, batch_size)
+    with FileWriter() as writer:
+        for i, (event_id, source_event, error, started) in enumerate(results):
+            try:
+                if error is not None:
+                    raise error
+                if pool is not None:
+                    if source_event["error"] is not None:
+                        raise RuntimeError(source_event["error"])
+                    event_info = source_event["record"]
+                else:
+                    event_info = map_resulted_event(source_event, race_type=event_race_types[event_id])
+                METRICS.count("records")
+                filename = resulted_event_filename(event_info, output_dir)
+                if tracker is not None and not tracker.changed("resulted", event_id, event_info, filename):
+                    logger.info(f"Result {i + 1} of {len(event_ids)}. Unchanged, not writing file {filename}.")
+                    METRICS.count("unchanged")
+                    imported.append(event_id)
+                    continue
+                if bundle is not None:
+                    writer.submit(partial(bundle.write, "resulted", event_id), [event_info], filename, started,
+                                  partial(written, i, event_id, event_info, filename))
+                else:
+                    writer.submit(write_resulted_event, event_info, filename, started,
+                                  partial(written, i, event_id, event_info, filename))
+            except Exception as e:
+                METRICS.count("errors")
+                logger.error(f"Error while importing resulted event id {event_id}: {sys.exc_info()[0]}")
+                logger.exception(e)
+    return imported
+
+
 def main(args):
     loglevel((5 - args.verbose) * 10)  # -v for error+critical, up to -vvvv for debug+
+    exporter = metrics_from_args(args)
 
-    cloudfare_cookie = get_cloudfare_cookie()
+    fetcher = fetcher_from_args(args, RESULTED_PROFILE_FIELDS, RESULTED_PROFILE_MAPPERS)
+    tracker = tracker_from_args(args)
     os.makedirs(args.output_dir, exist_ok=True)
-    locations = ["New Zealand", "Australia"]
-    resulted_events = get_resulted_event_list(cloudfare_cookie, locations, args.offset_days, args.race_type)
+    bundle = bundle_from_args(args)
+    pool = pool_from_args(args)
+    resulted_events = get_resulted_event_list(fetcher, LOCATIONS, args.offset_days, args.race_type,
+                                              stream=args.stream)
     if args.event_id is None:
         event_ids = [x["id"] for x in resulted_events]
+        if tracker is not None:
+            tracker.seen("resulted", args.race_type, args.offset_days, event_ids,
+                         starts={x["id"]: x.get("startTime") for x in resulted_events})
     else:
         event_ids = [args.event_id]
     logger.info("Found {n} events, with IDs {ids}".format(n=len(resulted_events),
                                                           ids=event_ids))
-    for i, event_id in enumerate(event_ids):
-        try:
-            time.sleep(0.5)  # Be a good citizen - avoid throttling by limiting request frequency
-            event_info = [get_resulted_event(cloudfare_cookie, event_id,
-                                             save_source=args.save_source,
-                                             output_dir=args.output_dir,
-                                             race_type=args.race_type)]
-            filename = f"{RACE_TYPES[args.race_type].lower()}-results-{event_info[0]['meeting number']}-"\
-                       f"{event_info[0]['meeting place'].replace(' ', '_')}-R{event_info[0]['race number']}.json"
-            filename = os.path.join(args.output_dir, filename)
-            with open(filename, "w") as outfile:
-                logger.info(f"Result {i + 1} of {len(event_ids)}. Writing file {filename}.")
-                json.dump(event_info, outfile, indent=4)
-        except Exception as e:
-            logger.error(f"Error while importing resulted event id {event_id}: {sys.exc_info()[0]}")
-            logger.exception(e)
+    import_resulted_events(fetcher, {event_id: args.race_type for event_id in event_ids},
+                           output_dir=args.output_dir, save_source=args.save_source, batch_size=args.batch_size,
+                           stream=args.stream, tracker=tracker, bundle=bundle, pool=pool)
+    if pool is not None:
+        pool.shutdown()
+    if bundle is not None:
+        bundle.close()
+    if tracker is not None:
+        tracker.finish(args.manifest)
+    close_fetcher(fetcher, args)
+    report_metrics(args, exporter)
 
 
 if __name__ == "__main__":
@@ -220,6 +425,10 @@ if __name__ == "__main__":
     parser.add_argument("-e", "--event-id", action="store", dest="event_id", default=None,
                         help="Specify an integer event ID to import a single race. "
                              "(intended for debugging - overrides other event selection parameters)")
+    add_fetch_arguments(parser)
+    add_change_arguments(parser)
+    add_bundle_arguments(parser)
+    add_metrics_arguments(parser)
 
     # Optional verbosity counter (eg. -v, -vv, -vvv, etc.)
     parser.add_argument(
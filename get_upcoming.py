@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 from copy import copy
+from functools import partial
 from json import JSONDecodeError
 
 __author__ = "Dustin Rasener"
@@ -10,15 +11,19 @@ import argparse
 import json
 import os
 import sys
-import time
-import requests
 from logzero import logger, loglevel, logfile
 try:
     from backports.datetime_fromisoformat import MonkeyPatch
     MonkeyPatch.patch_fromisoformat()
 except ImportError:
     pass
-from common import map_data, format_data, get_cloudfare_cookie, COMMON_HEADERS, RACE_TYPES
+from bundle import add_bundle_arguments, bundle_from_args
+from changes import add_change_arguments, tracker_from_args
+from common import (compile_mapping, format_data, EventIndex, fetch_batched, event_matches, stream_json_items,
+                    event_race_type, add_fetch_arguments, close_fetcher, fetcher_from_args, pool_from_args,
+                    EVENT_LIST_FIELDS, LOCATIONS, write_json, FileWriter, RACE_TYPES)
+from metrics import add_metrics_arguments, metrics_from_args, report_metrics, METRICS
+from odds_store import add_odds_arguments, odds_store_from_args, price_rows
 
 logfile("/tmp/get-upcoming.log", maxBytes=int(1e6), backupCount=10)
 
@@ -72,61 +77,99 @@ UPCOMING_RACE_GROUP_FORMAT_RULES = {
     "handicap": lambda x: "" if x == "fr" else x
 }
 UPCOMING_RACE_GROUP_MAPPINGS["GREYHOUNDS"] = copy(UPCOMING_RACE_GROUP_MAPPINGS["COMMON"])
+UPCOMING_RACE_DATA_MAPPER = compile_mapping(UPCOMING_RACE_DATA_MAPPING)
+UPCOMING_RACE_GROUP_MAPPERS = {k: compile_mapping(v) for k, v in UPCOMING_RACE_GROUP_MAPPINGS.items()}
+UPCOMING_EVENT_FIELDS = list(UPCOMING_RACE_DATA_MAPPING.values()) + [
+    "race.runners",
+    "markets.item.groupCode",
+    "markets.item.outcomes.item.id",
+    "markets.item.outcomes.item.name",
+    "markets.item.outcomes.item.prices.item.priceType",
+    "markets.item.outcomes.item.prices.item.decimal"
+]
 EVENT_LIST_URL = "https://content.tab.co.nz/content-service/api/v1/q/event-list?started=false&relativeMeetingOffsetDays={offset_days}&excludeResultedEvents=false&excludeExpiredMarkets=false&excludeSettledEvents=false&includeRace=true&includeMedia=true&includePools=true&drilldownTagIds=18%2C19%2C38"
 EVENT_INFO_URL = "https://content.tab.co.nz/content-service/api/v1/q/events-by-ids?eventIds={event_ids}&includeChildMarkets=true&includeCollections=false&includePriceHistory=true&includeCommentary=false&includeIncidents=false&includeRace=true&includeMedia=true&includePools=true"
+# Fields read from each endpoint, for lean fetch profiles (--lean)
+UPCOMING_PROFILE_FIELDS = {"event-list": EVENT_LIST_FIELDS, "events-by-ids": UPCOMING_EVENT_FIELDS}
 
 
-def get_upcoming_event_list(cloudfare_cookie, locations=None, offset_days=0, race_type="HORSE_RACING"):
-    if locations is None:
-        logger.warning('get_event_list: No locations specified. Event list will return no results.')
-        locations = []
-    event_list = requests.get(url=EVENT_LIST_URL.format(offset_days=offset_days),
-                              headers=COMMON_HEADERS.update({'__cfduid': cloudfare_cookie}))
+@METRICS.timed("list_fetch")
+def fetch_upcoming_event_list(fetcher, offset_days=0, stream=False, predicate=None):
+    """ Fetch the whole event list for a day, across every location and race type. With `stream`, the list is
+    parsed incrementally and only the fields needed to select events are kept. """
+    url = EVENT_LIST_URL.format(offset_days=offset_days)
+    if stream:
+        with fetcher.get(url=url, stream=True) as event_list, METRICS.stage("decode"):
+            return list(stream_json_items(event_list.raw, "data.events", fields=EVENT_LIST_FIELDS,
+                                          predicate=predicate))
+    event_list = fetcher.get(url=url)
     try:
-        event_list_json = event_list.json()
+        with METRICS.stage("decode"):
+            event_list_json = event_list.json()
     except JSONDecodeError:
         logger.error(f'Unable to decode JSON from response: {event_list}')
+        raise
     events = event_list_json['data']['events']
-    return [x for x in events if "class" in x and "name" in x["class"]
-            and x["class"]["name"] in locations
-            and "category" in x and "code" in x["category"]
-            and x["category"]["code"] == race_type]
+    return events if predicate is None else [x for x in events if predicate(x)]
 
 
-def get_odds(event_info, horse_name, price_type="WIN_POOL"):
-    logger.debug(json.dumps(event_info, indent=4))
-    win_market = next((x for x in event_info["markets"] if x["groupCode"] == "WINNER"), None)
+def get_upcoming_event_list(fetcher, locations=None, offset_days=0, race_type="HORSE_RACING", stream=False):
+    if locations is None:
+        logger.warning('get_event_list: No locations specified. Event list will return no results.')
+        locations = []
+    return fetch_upcoming_event_list(fetcher, offset_days, stream=stream,
+                                     predicate=partial(event_matches, locations=locations, race_type=race_type))
+
+
+@METRICS.timed("odds")
+def get_odds(event_index, horse_name, price_type="WIN_POOL"):
+    win_market = event_index.market("WINNER")
     if win_market is None:
-        logger.warning(f"No 'WINNER' market found, cannot return win odds for event id {event_info['id']}")
+        logger.warning(f"No 'WINNER' market found, cannot return win odds for event id {event_index.id}")
         return None
-    outcome = next((x for x in win_market["outcomes"] if x["name"] == horse_name), None)
+    outcome = event_index.outcome_by_name("WINNER", horse_name)
     if outcome is None:
-        logger.warning(f"No 'outcome' found for {horse_name} in event id {event_info['id']}")
+        logger.warning(f"No 'outcome' found for {horse_name} in event id {event_index.id}")
         return None
-    win_pool = next((x for x in outcome["prices"] if x["priceType"] == price_type), None)
+    win_pool = event_index.price(outcome, price_type)
     if win_pool is None:
-        logger.warning(f"No `{price_type}` price found for {horse_name} in event id {event_info['id']}")
+        logger.warning(f"No `{price_type}` price found for {horse_name} in event id {event_index.id}")
         return None
     return str(win_pool["decimal"])
 
 
-def get_event_info(cloudfare_cookie, event_id, save_source=False, output_dir=".", race_type="HORSE_RACING"):
-    event_info = requests.get(url=EVENT_INFO_URL.format(event_ids=event_id),
-                              headers=COMMON_HEADERS.update({'__cfduid': cloudfare_cookie})).json()
+@METRICS.timed("detail_fetch")
+def fetch_event_infos(fetcher, event_ids, save_source=False, output_dir=".", stream=False):
+    """ Fetch the source data for one or more events in a single request. With `stream` (and no source data to
+    save), events are parsed incrementally and only the fields used by the data maps and odds are kept. """
+    url = EVENT_INFO_URL.format(event_ids=",".join(str(x) for x in event_ids))
+    if stream and not save_source:
+        with fetcher.get(url=url, stream=True) as response, METRICS.stage("decode"):
+            return list(stream_json_items(response.raw, "data.events", fields=UPCOMING_EVENT_FIELDS))
+    response = fetcher.get(url=url)
+    with METRICS.stage("decode"):
+        response = response.json()
+    events = response['data']['events']
     if save_source:
-        filename = os.path.join(output_dir, f"{event_id}-event.json")
-        with open(filename, "w") as debugfile:
-            json.dump(event_info, debugfile, indent=4)
-    event_info = event_info['data']['events'][0]
-    mapped_event_info = map_data(event_info, mapping=UPCOMING_RACE_DATA_MAPPING)
+        for event in events:
+            filename = os.path.join(output_dir, f"{event['id']}-event.json")
+            with open(filename, "w") as debugfile:
+                json.dump({"data": {"events": [event]}}, debugfile, indent=4)
+    return events
+
+
+@METRICS.timed("map")
+def map_event_info(event_info, race_type="HORSE_RACING"):
+    event_index = EventIndex(event_info)
+    mapped_event_info = UPCOMING_RACE_DATA_MAPPER(event_info)
     mapped_event_info['type'] = race_type
     format_data(mapped_event_info, UPCOMING_RACE_FORMAT_RULES)
     mapped_event_info['group'] = []
     for runner in event_info['race']['runners']:
-        runner_info = map_data(runner, mapping=UPCOMING_RACE_GROUP_MAPPINGS[race_type])
-        win_odds = get_odds(event_info, runner["name"], price_type="LP")
+        runner_info = UPCOMING_RACE_GROUP_MAPPERS[race_type](runner)
+        win_odds = get_odds(event_index, runner["name"], price_type="LP")
         runner_info["indicative odds"] = win_odds
-        tote_odds = get_odds(event_info, runner["name"], price_type="WIN_POOL")
+        tote_odds = get_odds(event_index, runner["name"], price_type="WIN_POOL")
         runner_info["tote_odds"] = tote_odds
         format_data(runner_info, UPCOMING_RACE_GROUP_FORMAT_RULES)
         if str(runner_info["scratched"]).lower() != "true":
@@ -135,35 +178,168 @@ def get_event_info(cloudfare_cookie, event_id, save_source=False, output_dir="."
     return mapped_event_info
 
 
+def map_profiled_event_info(event_info):
+    """ What an import takes from an events-by-ids event, to check a lean fetch profile with: its record and the
+    odds store rows of its prices """
+    return map_event_info(event_info, race_type=event_race_type(event_info)), price_rows(event_info, timestamp=0)
+
+
+UPCOMING_PROFILE_MAPPERS = {"events-by-ids": map_profiled_event_info}
+
+
+def decode_event_infos(content, event_race_types, save_source=False, output_dir=".", with_prices=False):
+    """ Decode an events-by-ids response and map each of its events, in a worker process. Only the small results
+    go back to the parent: one {"id", "record", "prices", "error"} per event, `prices` being odds store rows. """
+    results = []
+    for event in json.loads(content)['data']['events']:
+        if str(event['id']) not in event_race_types:
+            continue
+        if save_source:
+            with open(os.path.join(output_dir, f"{event['id']}-event.json"), "w") as debugfile:
+                json.dump({"data": {"events": [event]}}, debugfile, indent=4)
+        result = {"id": event['id'], "record": None, "prices": None, "error": None}
+        try:
+            result["record"] = map_event_info(event, race_type=event_race_types[str(event['id'])])
+        except Exception as e:
+            logger.exception(e)
+            result["error"] = f"{type(e).__name__}: {e}"
+        if with_prices:
+            try:
+                result["prices"] = price_rows(event)
+            except Exception as e:
+                logger.error(f"Error while reading the odds of upcoming event id {event['id']}: {sys.exc_info()[0]}")
+                logger.exception(e)
+        results.append(result)
+    return results
+
+
+def fetch_mapped_event_infos(fetcher, pool, event_ids, event_race_types, save_source=False, output_dir=".",
+                             with_prices=False):
+    """ Fetch one or more events in a single request, then decode and map them on the process pool """
+    url = EVENT_INFO_URL.format(event_ids=",".join(str(x) for x in event_ids))
+    content = fetcher.get(url=url).content
+    with METRICS.stage("pool"):
+        return pool.submit(decode_event_infos, content, {str(x): event_race_types[x] for x in event_ids},
+                           save_source, output_dir, with_prices).result()
+
+
+def get_event_info(fetcher, event_id, save_source=False, output_dir=".", race_type="HORSE_RACING"):
+    event_info = fetch_event_infos(fetcher, [event_id], save_source=save_source, output_dir=output_dir)[0]
+    return map_event_info(event_info, race_type=race_type)
+
+
+def event_filename(event_info, output_dir="."):
+    filename = f"{event_info['type'].lower()}-{event_info['meeting number']}-" \
+               f"{str(event_info['meeting place']).replace(' ', '_')}" \
+               f"-R{event_info['race number']}.json"
+    return os.path.join(output_dir, filename)
+
+
+@METRICS.timed("write")
+def write_event_info(event_info, filename):
+    write_json([event_info], filename)
+
+
+def import_events(fetcher, event_race_types, output_dir=".", save_source=False, batch_size=10, stream=False,
+                  tracker=None, bundle=None, odds_store=None, pool=None):
+    """ Fetch, map and write out each event. `event_race_types` maps each event id to its race type. With a
+    `tracker`, races whose output has not changed since the last run are not written. With a
+    `bundle`, records are added to it instead of being written to their own files. With an `odds_store`, the
+    prices of every runner are appended to it as well. With a process `pool`, responses are decoded and mapped
+    on it; records are still written here, in the same order.
+
+    The stages overlap: chunks are fetched ahead on the fetcher's workers, events are mapped here (or on the
+    pool) as their chunk arrives, and files are written on a FileWriter thread. Each stage hands over through a
+    bounded window, so a slow stage holds back the ones before it. Each file is renamed into place once it has
+    been written, and the time from the start of its fetch is logged. """
+    event_ids = list(event_race_types)
+
+    def written(i, event_id, event_info, filename, latency):
+        if tracker is not None:
+            tracker.commit("upcoming", event_id, event_info, filename)
+        METRICS.count("written")
+        logger.info(f"Race {i+1} of {len(event_ids)}. Wrote file {filename} {latency:.2f}s after fetching it.")
+
+    if pool is not None:
+        fetch_events = partial(fetch_mapped_event_infos, fetcher, pool, event_race_types=event_race_types,
+                               save_source=save_source, output_dir=output_dir, with_prices=odds_store is not None)
+    else:
+        fetch_events = partial(fetch_event_infos, fetcher, save_source=save_source, output_dir=output_dir,
+                               stream=stream)
+    results = fetch_batched(fetcher, fetch_events, event_ids, batch_size)
+    with FileWriter() as writer:
+        for i, (event_id, source_event, error, started) in enumerate(results):
+            try:
+                if error is not None:
+                    raise error
+                if pool is not None:
+                    if source_event["error"] is not None:
+                        raise RuntimeError(source_event["error"])
+                    event_info = source_event["record"]
+                else:
+                    event_info = map_event_info(source_event, race_type=event_race_types[event_id])
+                if odds_store is not None:
+                    try:
+                        if pool is not None:
+                            odds_store.append(source_event["prices"] or [])
+                        else:
+                            odds_store.add_event(source_event)
+                    except Exception as e:
+                        METRICS.count("errors")
+                        logger.error(f"Error while storing the odds of upcoming event id {event_id}: "
+                                     f"{sys.exc_info()[0]}")
+                        logger.exception(e)
+                METRICS.count("records")
+                filename = event_filename(event_info, output_dir)
+                if tracker is not None and not tracker.changed("upcoming", event_id, event_info, filename):
+                    logger.info(f"Race {i+1} of {len(event_ids)}. Unchanged, not writing file {filename}.")
+                    METRICS.count("unchanged")
+                    continue
+                if bundle is not None:
+                    writer.submit(partial(bundle.write, "upcoming", event_id), [event_info], filename, started,
+                                  partial(written, i, event_id, event_info, filename))
+                else:
+                    writer.submit(write_event_info, event_info, filename, started,
+                                  partial(written, i, event_id, event_info, filename))
+            except Exception as e:
+                METRICS.count("errors")
+                logger.error(f"Error while importing upcoming event id {event_id}: {sys.exc_info()[0]}")
+                logger.exception(e)
+
+
 def main(args):
     loglevel((5 - args.verbose) * 10)  # -v for error+critical, up to -vvvv for debug+
-    cloudfare_cookie = get_cloudfare_cookie()
+    exporter = metrics_from_args(args)
+    fetcher = fetcher_from_args(args, UPCOMING_PROFILE_FIELDS, UPCOMING_PROFILE_MAPPERS)
+    tracker = tracker_from_args(args)
     os.makedirs(args.output_dir, exist_ok=True)
-    locations = ["New Zealand", "Australia"]
-    upcoming_events = get_upcoming_event_list(cloudfare_cookie, locations, args.offset_days, args.race_type)
+    bundle = bundle_from_args(args)
+    odds_store = odds_store_from_args(args)
+    pool = pool_from_args(args)
+    upcoming_events = get_upcoming_event_list(fetcher, LOCATIONS, args.offset_days, args.race_type,
+                                              stream=args.stream)
     if args.event_id is None:
         event_ids = [x["id"] for x in upcoming_events]
+        if tracker is not None:
+            tracker.seen("upcoming", args.race_type, args.offset_days, event_ids,
+                         starts={x["id"]: x.get("startTime") for x in upcoming_events})
     else:
         event_ids = [args.event_id]
     logger.info("Found {n} events, with IDs {ids}".format(n=len(upcoming_events),
                                                           ids=event_ids))
-    for i, event_id in enumerate(event_ids):
-        try:
-            time.sleep(0.5)  # Be a good citizen - avoid throttling by limiting request frequency
-            event_info = [get_event_info(cloudfare_cookie, event_id,
-                                         save_source=args.save_source,
-                                         output_dir=args.output_dir,
-                                         race_type=args.race_type)]
-            filename = f"{RACE_TYPES[args.race_type].lower()}-{event_info[0]['meeting number']}-" \
-                       f"{str(event_info[0]['meeting place']).replace(' ', '_')}" \
-                       f"-R{event_info[0]['race number']}.json"
-            filename = os.path.join(args.output_dir, filename)
-            with open(filename, "w") as outfile:
-                logger.info(f"Race {i+1} of {len(event_ids)}. Writing file {filename}.")
-                json.dump(event_info, outfile, indent=4)
-        except Exception as e:
-            logger.error(f"Error while importing upcoming event id {event_id}: {sys.exc_info()[0]}")
-            logger.exception(e)
+    import_events(fetcher, {event_id: args.race_type for event_id in event_ids}, output_dir=args.output_dir,
+                  save_source=args.save_source, batch_size=args.batch_size, stream=args.stream, tracker=tracker,
+                  bundle=bundle, odds_store=odds_store, pool=pool)
+    if pool is not None:
+        pool.shutdown()
+    if bundle is not None:
+        bundle.close()
+    if odds_store is not None:
+        odds_store.close()
+    if tracker is not None:
+        tracker.finish(args.manifest)
+    close_fetcher(fetcher, args)
+    report_metrics(args, exporter)
 
 
 if __name__ == "__main__":
@@ -180,6 +356,11 @@ if __name__ == "__main__":
     parser.add_argument("-e", "--event-id", action="store", dest="event_id", default=None,
                         help="Specify an integer event ID to import a single race. "
                              "(intended for debugging - overrides other event selection parameters)")
+    add_fetch_arguments(parser)
+    add_change_arguments(parser)
+    add_bundle_arguments(parser)
+    add_odds_arguments(parser)
+    add_metrics_arguments(parser)
 
     # Optional verbosity counter (eg. -v, -vv, -vvv, etc.)
     parser.add_argument(
@@ -0,0 +1,192 @@
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+from urllib.parse import urlparse
+import requests
+from requests.structures import CaseInsensitiveDict
+from logzero import logger
+
+
+def endpoint_name(url):
+    """ Last path segment of a URL, e.g. "resulted-events" """
+    return urlparse(url).path.rstrip("/").rsplit("/", 1)[-1]
+
+
+def build_response(url, content, headers=None):
+    """ Build a `requests.Response` from stored bytes, usable with `.json()` and with streaming from `.raw` """
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response.headers = CaseInsensitiveDict(headers or {})
+    response.encoding = "utf-8"
+    response._content = content
+    response.raw = io.BytesIO(content)
+    return response
+
+
+class ResponseCache:
+    """ Content-addressed on-disk cache of response bodies, keyed by URL.
+
+    Each entry is fresh for the TTL of its endpoint (`ttls` maps endpoint name to seconds; endpoints that are not
+    listed are not cached). Stale entries are revalidated with ETag/Last-Modified when the server sent them.
+    Bodies are evicted least-recently-used first once the cache grows beyond `max_bytes`. """
+
+    INDEX_FILE = "index.json"
+
+    def __init__(self, directory, ttls, max_bytes=500 * 2 ** 20):
+        self.directory = directory
+        self.ttls = ttls
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "revalidated": 0, "stored": 0, "evicted": 0}
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(os.path.join(directory, self.INDEX_FILE)) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+
+    @staticmethod
+    def key(url):
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def cacheable(self, url):
+        return endpoint_name(url) in self.ttls
+
+    def lookup(self, url):
+        """ Return (entry, body) for a URL, or (None, None) when it is not cached """
+        key = self.key(url)
+        with self.lock:
+            entry = self.index.get(key)
+        if entry is None:
+            return None, None
+        try:
+            with open(self.path(key), "rb") as f:
+                body = f.read()
+        except OSError:
+            with self.lock:
+                self.index.pop(key, None)
+            return None, None
+        return entry, body
+
+    def is_fresh(self, entry):
+        return time.time() - entry["stored"] < entry["ttl"]
+
+    def has_fresh(self, url):
+        """ Whether a fresh copy of a URL is cached, without reading it """
+        with self.lock:
+            entry = self.index.get(self.key(url))
+        return entry is not None and self.is_fresh(entry)
+
+    def fresh(self, url):
+        """ Body of the fresh cached copy of a URL, or None. Never requests it. """
+        entry, body = self.lookup(url)
+        if entry is None or not self.is_fresh(entry):
+            return None
+        self.touch(url)
+        self.count("hits")
+        return body
+
+    def get(self, url, fetch):
+        """ Return the response for a URL from the cache when fresh. Otherwise call `fetch(headers)` to request it,
+        with conditional headers when a stale entry can be revalidated, and store the result. """
+        entry, body = self.lookup(url)
+        if entry is not None and self.is_fresh(entry):
+            self.touch(url)
+            self.count("hits")
+            return build_response(url, body, entry["headers"])
+        headers = {}
+        if entry is not None and entry["headers"].get("ETag"):
+            headers["If-None-Match"] = entry["headers"]["ETag"]
+        if entry is not None and entry["headers"].get("Last-Modified"):
+            headers["If-Modified-Since"] = entry["headers"]["Last-Modified"]
+        response = fetch(headers)
+        if response.status_code == 304 and entry is not None:
+            self.count("revalidated")
+            self.touch(url, refresh=True)
+            return build_response(url, body, entry["headers"])
+        self.count("misses")
+        if response.status_code == 200:
+            self.store(url, response.content, response.headers)
+        return response
+
+    def store(self, url, content, headers, ttl=None):
+        key = self.key(url)
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(content)
+        os.replace(temp_path, path)
+        kept_headers = {k: headers[k] for k in ("ETag", "Last-Modified", "Content-Type") if k in headers}
+        now = time.time()
+        with self.lock:
+            self.index[key] = {"url": url, "stored": now, "accessed": now, "size": len(content),
+                               "ttl": self.ttls[endpoint_name(url)] if ttl is None else ttl,
+                               "headers": kept_headers}
+        self.count("stored")
+        self.evict()
+
+    def touch(self, url, refresh=False):
+        with self.lock:
+            entry = self.index.get(self.key(url))
+            if entry is not None:
+                entry["accessed"] = time.time()
+                if refresh:
+                    entry["stored"] = entry["accessed"]
+
+    def set_ttl(self, url, ttl):
+        """ Override the TTL of a stored entry, e.g. to keep a settled result for longer """
+        with self.lock:
+            entry = self.index.get(self.key(url))
+            if entry is not None:
+                entry["ttl"] = ttl
+
+    def evict(self):
+        with self.lock:
+            total = sum(x["size"] for x in self.index.values())
+            if total <= self.max_bytes:
+                return
+            victims = []
+            for key, entry in sorted(self.index.items(), key=lambda x: x[1]["accessed"]):
+                if total <= self.max_bytes:
+                    break
+                total -= entry["size"]
+                victims.append(key)
+            for key in victims:
+                del self.index[key]
+        for key in victims:
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+            self.count("evicted")
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def save(self):
+        """ Write the index to disk so that the next run can use the cached bodies """
+        self.evict()
+        path = os.path.join(self.directory, self.INDEX_FILE)
+        with self.lock:
+            with open(f"{path}.tmp", "w") as f:
+                json.dump(self.index, f)
+            os.replace(f"{path}.tmp", path)
+
+    def report(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self.index)
+            stats["bytes"] = sum(x["size"] for x in self.index.values())
+        lookups = stats["hits"] + stats["revalidated"] + stats["misses"]
+        stats["hit_ratio"] = round((stats["hits"] + stats["revalidated"]) / lookups, 3) if lookups else 0.0
+        logger.info(f"Cache stats: {json.dumps(stats)}")
+        return stats
@@ -0,0 +1,181 @@
+import functools
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import nullcontext
+from logzero import logger
+
+PROMETHEUS_PREFIX = "tabscraper"
+
+_DISABLED = nullcontext()
+
+
+class _Stage:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.started)
+        return False
+
+
+class Metrics:
+    """ Wall time per pipeline stage plus named counters (requests, bytes received, records, retries, errors).
+
+    Disabled by default, in which case `stage` returns a shared no-op context manager and `count` returns straight
+    away, so instrumenting the hot path costs a method call. """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.stages = {}
+        self.counters = {}
+
+    def enable(self):
+        self.enabled = True
+        self.started = time.monotonic()
+
+    def stage(self, name):
+        """ Context manager that adds the time spent in its body to a stage """
+        if not self.enabled:
+            return _DISABLED
+        return _Stage(self, name)
+
+    def timed(self, name):
+        """ Decorator that adds the time spent in each call of a function to a stage """
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with _Stage(self, name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def observe(self, name, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                self.stages[name] = stage = {"calls": 0, "seconds": 0.0, "max_seconds": 0.0}
+            stage["calls"] += 1
+            stage["seconds"] += seconds
+            stage["max_seconds"] = max(stage["max_seconds"], seconds)
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        with self.lock:
+            stages = {k: dict(v) for k, v in self.stages.items()}
+            counters = dict(self.counters)
+        for stage in stages.values():
+            stage["mean_seconds"] = stage["seconds"] / stage["calls"] if stage["calls"] else 0.0
+        return {"elapsed_seconds": time.monotonic() - self.started, "stages": stages, "counters": counters}
+
+    def prometheus(self):
+        """ The summary in the Prometheus text exposition format """
+        summary = self.summary()
+        lines = [f"# TYPE {PROMETHEUS_PREFIX}_stage_calls_total counter",
+                 f"# TYPE {PROMETHEUS_PREFIX}_stage_seconds_total counter",
+                 f"# TYPE {PROMETHEUS_PREFIX}_stage_max_seconds gauge"]
+        for name, stage in sorted(summary["stages"].items()):
+            lines.append(f'{PROMETHEUS_PREFIX}_stage_calls_total{{stage="{name}"}} {stage["calls"]}')
+            lines.append(f'{PROMETHEUS_PREFIX}_stage_seconds_total{{stage="{name}"}} {stage["seconds"]:.6f}')
+            lines.append(f'{PROMETHEUS_PREFIX}_stage_max_seconds{{stage="{name}"}} {stage["max_seconds"]:.6f}')
+        for name, value in sorted(summary["counters"].items()):
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name}_total counter")
+            lines.append(f"{PROMETHEUS_PREFIX}_{name}_total {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, filename):
+        """ Write the Prometheus text to a file, replaced atomically so that a textfile collector never reads half
+        of it """
+        with open(f"{filename}.tmp", "w") as f:
+            f.write(self.prometheus())
+        os.replace(f"{filename}.tmp", filename)
+
+
+class StatsdExporter:
+    """ Sends what has changed since the last `flush` to a StatsD server over UDP: counters as `|c` and the time
+    spent in each stage, in milliseconds, as `|ms` """
+
+    def __init__(self, metrics, address, prefix=PROMETHEUS_PREFIX):
+        host, _, port = address.rpartition(":")
+        self.metrics = metrics
+        self.address = (host or "127.0.0.1", int(port))
+        self.prefix = prefix
+        self.sent = {}
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def flush(self):
+        summary = self.metrics.summary()
+        totals = {f"{k}:c": v for k, v in summary["counters"].items()}
+        for name, stage in summary["stages"].items():
+            totals[f"stage.{name}.calls:c"] = stage["calls"]
+            totals[f"stage.{name}:ms"] = stage["seconds"] * 1000
+        packets = []
+        for key, total in totals.items():
+            delta = total - self.sent.get(key, 0)
+            if delta:
+                name, kind = key.rsplit(":", 1)
+                packets.append(f"{self.prefix}.{name}:{delta:g}|{kind}")
+            self.sent[key] = total
+        for packet in packets:
+            try:
+                self.socket.sendto(packet.encode("utf-8"), self.address)
+            except OSError as e:
+                logger.warning(f"Unable to send metrics to StatsD at {self.address}: {e}")
+                break
+
+
+METRICS = Metrics()
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument("--profile", action="store_true", dest="profile", default=False,
+                        help="Time each stage of the run and print a JSON summary at exit")
+    parser.add_argument("--metrics-file", action="store", dest="metrics_file", default=None,
+                        help="Write stage timings and counters to this file in the Prometheus text format")
+    parser.add_argument("--statsd", action="store", dest="statsd", default=None,
+                        help="Send stage timings and counters to this StatsD HOST:PORT")
+
+
+def metrics_from_args(args):
+    """ Turn on instrumentation if any of the outputs were asked for. Returns a StatsD exporter, or None. """
+    if args.profile or args.metrics_file is not None or args.statsd is not None:
+        METRICS.enable()
+    return StatsdExporter(METRICS, args.statsd) if args.statsd is not None else None
+
+
+def flush_metrics(args, exporter=None):
+    """ Write and send the metrics so far, as asked for on the command line. Long-running scripts call this
+    periodically, as well as at exit. """
+    if not METRICS.enabled:
+        return
+    if args.metrics_file is not None:
+        METRICS.write_prometheus(args.metrics_file)
+    if exporter is not None:
+        exporter.flush()
+
+
+def report_metrics(args, exporter=None):
+    """ Print, write and send the metrics of the run, as asked for on the command line """
+    if not METRICS.enabled:
+        return
+    if args.profile:
+        print(json.dumps(METRICS.summary(), indent=4))
+    flush_metrics(args, exporter)
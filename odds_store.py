@@ -0,0 +1,164 @@
+import json
+import os
+import threading
+import time
+from logzero import logger
+from common import EventIndex
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Column name and dtype of each file in the store. Price types are stored as an index into `price_types.json`.
+COLUMNS = [
+    ("event_id", "<i8"),
+    ("runner", "<i4"),
+    ("price_type", "<u1"),
+    ("timestamp", "<f8"),
+    ("decimal", "<f8")
+]
+PRICE_TYPES_FILE = "price_types.json"
+# Seconds back from now that rows are read to find the last price of each series when a store is opened. Races are
+# not priced for this long, so older series cannot move again.
+LAST_PRICES_WINDOW = 7 * 24 * 60 * 60
+
+
+def price_rows(event_info, timestamp=None):
+    """ (event_id, runner, price_type, timestamp, decimal) rows of the current price of every type for each runner
+    of a source event. Runners without a number are skipped. """
+    timestamp = time.time() if timestamp is None else timestamp
+    event_index = EventIndex(event_info)
+    rows = []
+    for runner in event_info.get("race", {}).get("runners", []):
+        outcome = event_index.outcome_by_name("WINNER", runner.get("name"))
+        number = runner.get("raceDetails", {}).get("number")
+        if outcome is None or number is None:
+            continue
+        seen = set()
+        for price in outcome.get("prices", []):
+            if price.get("priceType") in seen or price.get("decimal") is None:
+                continue
+            seen.add(price.get("priceType"))
+            rows.append((event_info["id"], number, price["priceType"], timestamp, price["decimal"]))
+    return rows
+
+
+class OddsStore:
+    """ Append-only columnar store of runner prices over time, one file per column in a directory.
+
+    Every row is (event_id, runner number, price type, timestamp, decimal). A price is only appended when it differs
+    from the last one stored for the same runner and price type, so polling a race that has not moved adds nothing.
+    Rows are appended to the column files and read back through memory maps, so queries do not parse any JSON. """
+
+    def __init__(self, directory):
+        if numpy is None:
+            raise RuntimeError("The odds store requires the numpy package")
+        self.directory = directory
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(os.path.join(directory, PRICE_TYPES_FILE)) as f:
+                self.price_types = json.load(f)
+        except (OSError, ValueError):
+            self.price_types = []
+        self.truncate()
+        self.last = self.last_prices()
+        self.appended = 0
+
+    def path(self, column):
+        return os.path.join(self.directory, f"{column}.bin")
+
+    def __len__(self):
+        sizes = [os.path.getsize(self.path(name)) // numpy.dtype(dtype).itemsize if os.path.exists(self.path(name))
+                 else 0 for name, dtype in COLUMNS]
+        return min(sizes)
+
+    def truncate(self):
+        """ Cut every column to the same number of rows, in case a previous run stopped part way through an
+        append """
+        rows = len(self)
+        for name, dtype in COLUMNS:
+            with open(self.path(name), "ab") as f:
+                f.truncate(rows * numpy.dtype(dtype).itemsize)
+
+    def column(self, name):
+        """ Read-only memory map of one column """
+        rows = len(self)
+        dtype = dict(COLUMNS)[name]
+        if rows == 0:
+            return numpy.empty(0, dtype=dtype)
+        return numpy.memmap(self.path(name), dtype=dtype, mode="r", shape=(rows,))
+
+    def last_prices(self, window=LAST_PRICES_WINDOW):
+        """ {(event_id, runner, price type code): decimal} of the latest row of each series with a row in the last
+        `window` seconds. Only those rows are read, so opening the store does not get slower as it grows. """
+        recent = numpy.nonzero(self.column("timestamp") >= time.time() - window)[0]
+        columns = [numpy.asarray(self.column(name)[recent]).tolist() for name, _ in COLUMNS]
+        last = {}
+        for event_id, runner, price_type, _, decimal in zip(*columns):
+            last[(event_id, runner, price_type)] = decimal
+        return last
+
+    def price_type_code(self, price_type):
+        if price_type not in self.price_types:
+            self.price_types.append(price_type)
+            with open(os.path.join(self.directory, f"{PRICE_TYPES_FILE}.tmp"), "w") as f:
+                json.dump(self.price_types, f)
+            os.replace(os.path.join(self.directory, f"{PRICE_TYPES_FILE}.tmp"),
+                       os.path.join(self.directory, PRICE_TYPES_FILE))
+        return self.price_types.index(price_type)
+
+    def append(self, rows):
+        """ Append (event_id, runner, price_type, timestamp, decimal) rows, skipping prices that have not moved.
+        Returns the number of rows stored. """
+        with self.lock:
+            kept = []
+            for event_id, runner, price_type, timestamp, decimal in rows:
+                key = (int(event_id), int(runner), self.price_type_code(price_type))
+                if self.last.get(key) == float(decimal):
+                    continue
+                self.last[key] = float(decimal)
+                kept.append(key + (float(timestamp), float(decimal)))
+            if not kept:
+                return 0
+            values = list(zip(*kept))
+            for (name, dtype), column in zip(COLUMNS, values):
+                with open(self.path(name), "ab") as f:
+                    f.write(numpy.asarray(column, dtype=dtype).tobytes())
+            self.appended += len(kept)
+            return len(kept)
+
+    def add_event(self, event_info, timestamp=None):
+        """ Store the current price of every type for each runner of a source event """
+        return self.append(price_rows(event_info, timestamp))
+
+    def query(self, event_id, runner=None, price_type=None):
+        """ Rows of one race, optionally of one runner and price type, as a NumPy structured array sorted by time.
+        `price_type` in the result is the name of the price type. """
+        mask = self.column("event_id") == int(event_id)
+        if runner is not None:
+            mask &= self.column("runner") == int(runner)
+        if price_type is not None:
+            if price_type not in self.price_types:
+                mask[:] = False
+            else:
+                mask &= self.column("price_type") == self.price_types.index(price_type)
+        result = numpy.empty(int(mask.sum()), dtype=[("event_id", "<i8"), ("runner", "<i4"), ("price_type", "U16"),
+                                                     ("timestamp", "<f8"), ("decimal", "<f8")])
+        for name, _ in COLUMNS:
+            values = numpy.asarray(self.column(name)[mask])
+            result[name] = numpy.array(self.price_types)[values] if name == "price_type" and len(values) else values
+        return numpy.sort(result, order=["timestamp", "runner", "price_type"])
+
+    def close(self):
+        logger.info(f"Stored {self.appended} prices that moved, {len(self)} in total in {self.directory}")
+
+
+def add_odds_arguments(parser):
+    parser.add_argument("--odds-store", action="store", dest="odds_store", default=None,
+                        help="Append every runner price that moved to the columnar odds store in this directory "
+                             "(requires numpy)")
+
+
+def odds_store_from_args(args):
+    return OddsStore(args.odds_store) if args.odds_store is not None else None
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+""" Record every HTTP exchange of a run, and replay them from a local stand-in for the TAB API.
+
+Record with `--record DIR` on any of the scraping scripts. Then serve the recording with
+`python replay.py DIR` and point a run at it with `--base-url http://127.0.0.1:8000`. """
+import argparse
+import hashlib
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+from logzero import logger
+
+EXCHANGES_FILE = "exchanges.jsonl"
+
+
+def request_key(url):
+    """ Path and query of a URL, which is what the replay server matches requests on """
+    parts = urlsplit(url)
+    return f"{parts.path}?{parts.query}" if parts.query else parts.path
+
+
+class Recorder:
+    """ Appends each exchange to `exchanges.jsonl` in a directory, with bodies stored once by content hash """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(directory, "bodies"), exist_ok=True)
+
+    def record(self, url, status_code, headers, content, elapsed=None):
+        digest = hashlib.sha256(content).hexdigest()
+        body_path = os.path.join(self.directory, "bodies", digest)
+        exchange = {"url": url, "status": status_code, "body": digest, "elapsed": elapsed,
+                    "headers": {k: v for k, v in headers.items() if k.lower() in ("content-type", "etag",
+                                                                                   "last-modified")}}
+        with self.lock:
+            if not os.path.exists(body_path):
+                with open(body_path, "wb") as f:
+                    f.write(content)
+            with open(os.path.join(self.directory, EXCHANGES_FILE), "a") as f:
+                f.write(json.dumps(exchange) + "\n")
+
+
+def load_exchanges(directory):
+    """ Map each recorded request key to its latest exchange """
+    exchanges = {}
+    with open(os.path.join(directory, EXCHANGES_FILE)) as f:
+        for line in f:
+            if line.strip():
+                exchange = json.loads(line)
+                exchanges[request_key(exchange["url"])] = exchange
+    return exchanges
+
+
+class ReplayServer:
+    """ Local HTTP server that answers requests from a recording, 404 for anything that was not recorded """
+
+    def __init__(self, directory, host="127.0.0.1", port=0):
+        self.directory = directory
+        self.exchanges = load_exchanges(directory)
+        self.bytes_sent = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                exchange = server.exchanges.get(self.path)
+                if exchange is None:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                with open(os.path.join(server.directory, "bodies", exchange["body"]), "rb") as f:
+                    body = f.read()
+                self.send_response(exchange["status"])
+                for key, value in exchange["headers"].items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                server.bytes_sent += len(body)
+
+            def log_message(self, format, *args):
+                logger.debug(f"replay: {format % args}")
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """ Serve on a background thread """
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", help="Directory recorded with --record")
+    parser.add_argument("--host", action="store", dest="host", default="127.0.0.1")
+    parser.add_argument("-p", "--port", action="store", dest="port", type=int, default=8000)
+    args = parser.parse_args()
+    replay_server = ReplayServer(args.directory, host=args.host, port=args.port)
+    print(f"Replaying {len(replay_server.exchanges)} exchanges on {replay_server.url}")
+    replay_server.httpd.serve_forever()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+__author__ = "Dustin Rasener"
+__version__ = "0.1.0"
+__license__ = "Proprietary"
+
+import argparse
+import os
+import sys
+from functools import partial
+from logzero import logger, loglevel, logfile
+from bundle import add_bundle_arguments, bundle_from_args
+from changes import add_change_arguments, tracker_from_args
+from common import (event_matches, filter_events, add_fetch_arguments, close_fetcher, fetcher_from_args, pool_from_args,
+                    LOCATIONS, RACE_TYPES)
+from get_upcoming import fetch_upcoming_event_list, import_events, UPCOMING_PROFILE_FIELDS, UPCOMING_PROFILE_MAPPERS
+from get_resulted import (fetch_resulted_event_list, import_resulted_events, RESULTED_PROFILE_FIELDS,
+                          RESULTED_PROFILE_MAPPERS)
+from metrics import add_metrics_arguments, metrics_from_args, report_metrics, METRICS
+from odds_store import add_odds_arguments, odds_store_from_args
+
+logfile("/tmp/run-jobs.log", maxBytes=int(1e6), backupCount=10)
+
+
+def partition_events(events, race_types, locations=LOCATIONS):
+    """ Split one downloaded event list into {event_id: race_type} for each requested race type """
+    event_race_types = {}
+    for race_type in race_types:
+        for event in filter_events(events, locations, race_type):
+            event_race_types[event["id"]] = race_type
+    return event_race_types
+
+
+def track_jobs(tracker, kind, offset_days, race_types, jobs, events):
+    """ Register the events listed for each requested race type of one offset with the change tracker, including
+    race types with no events left, so that the races last listed under them are removed """
+    if tracker is None:
+        return
+    starts = {x["id"]: x.get("startTime") for x in events}
+    for race_type in race_types:
+        tracker.seen(kind, race_type, offset_days, [k for k, v in jobs.items() if v == race_type], starts=starts)
+
+
+def run_jobs(fetcher, upcoming_days, resulted_days, race_types, output_dir=".", save_source=False, batch_size=10,
+             stream=False, tracker=None, bundle=None, odds_store=None, pool=None):
+    """ Run every (offset x race type) job for upcoming and resulted races. Each event list is downloaded once
+    per offset and shared between race types, and all detail fetches go through the same fetcher. An event list
+    that cannot be fetched is logged and skipped, so the other jobs still run. """
+    in_locations = partial(event_matches, locations=LOCATIONS)
+    upcoming = {}
+    for offset_days in upcoming_days:
+        try:
+            events = fetch_upcoming_event_list(fetcher, offset_days, stream=stream, predicate=in_locations)
+        except Exception as e:
+            METRICS.count("errors")
+            logger.error(f"Error while fetching the upcoming event list for offset {offset_days}: {sys.exc_info()[0]}")
+            logger.exception(e)
+            continue
+        jobs = partition_events(events, race_types)
+        logger.info(f"Found {len(jobs)} upcoming events for offset {offset_days}")
+        track_jobs(tracker, "upcoming", offset_days, race_types, jobs, events)
+        upcoming.update(jobs)
+    import_events(fetcher, upcoming, output_dir=output_dir, save_source=save_source, batch_size=batch_size,
+                  stream=stream, tracker=tracker, bundle=bundle, odds_store=odds_store, pool=pool)
+
+    resulted = {}
+    for offset_days in resulted_days:
+        try:
+            events = fetch_resulted_event_list(fetcher, offset_days, stream=stream, predicate=in_locations)
+        except Exception as e:
+            METRICS.count("errors")
+            logger.error(f"Error while fetching the resulted event list for offset {offset_days}: {sys.exc_info()[0]}")
+            logger.exception(e)
+            continue
+        jobs = partition_events(events, race_types)
+        logger.info(f"Found {len(jobs)} resulted events for offset {offset_days}")
+        track_jobs(tracker, "resulted", offset_days, race_types, jobs, events)
+        resulted.update(jobs)
+    import_resulted_events(fetcher, resulted, output_dir=output_dir, save_source=save_source,
+                           batch_size=batch_size, stream=stream, tracker=tracker, bundle=bundle, pool=pool)
+
+
+def main(args):
+    loglevel((5 - args.verbose) * 10)  # -v for error+critical, up to -vvvv for debug+
+    exporter = metrics_from_args(args)
+    race_types = args.race_types.split(",")
+    for race_type in race_types:
+        if race_type not in RACE_TYPES:
+            raise ValueError(f"Unknown race type {race_type}")
+    fetcher = fetcher_from_args(args, {**UPCOMING_PROFILE_FIELDS, **RESULTED_PROFILE_FIELDS},
+                                {**UPCOMING_PROFILE_MAPPERS, **RESULTED_PROFILE_MAPPERS})
+    tracker = tracker_from_args(args)
+    os.makedirs(args.output_dir, exist_ok=True)
+    bundle = bundle_from_args(args)
+    odds_store = odds_store_from_args(args)
+    pool = pool_from_args(args)
+    run_jobs(fetcher,
+             upcoming_days=[x for x in args.upcoming_days.split(",") if x != ""],
+             resulted_days=[x for x in args.resulted_days.split(",") if x != ""],
+             race_types=race_types,
+             output_dir=args.output_dir,
+             save_source=args.save_source,
+             batch_size=args.batch_size,
+             stream=args.stream,
+             tracker=tracker,
+             bundle=bundle,
+             odds_store=odds_store,
+             pool=pool)
+    if pool is not None:
+        pool.shutdown()
+    if bundle is not None:
+        bundle.close()
+    if odds_store is not None:
+        odds_store.close()
+    if tracker is not None:
+        tracker.finish(args.manifest)
+    close_fetcher(fetcher, args)
+    report_metrics(args, exporter)
+
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-o", "--output_dir", action="store", dest="output_dir", default="./events")
+    parser.add_argument("-u", "--upcoming-days", action="store", dest="upcoming_days", default="0,1,2",
+                        help="Comma-separated days in the future to get race info for (defaults to 0,1,2)")
+    parser.add_argument("-p", "--resulted-days", action="store", dest="resulted_days", default="0,1",
+                        help="Comma-separated days in the past to get results for (defaults to 0,1)")
+    parser.add_argument("-r", "--race-types", action="store", dest="race_types",
+                        default="HORSE_RACING,HARNESS_RACING,GREYHOUNDS",
+                        help="Comma-separated race types (defaults to HORSE_RACING,HARNESS_RACING,GREYHOUNDS)")
+    parser.add_argument("-s", "--save-source-data", action="store_true", dest="save_source", default=False,
+                        help="Save source data files for debugging (warning: large files -- 3-6MB each)")
+    add_fetch_arguments(parser)
+    add_change_arguments(parser)
+    add_bundle_arguments(parser)
+    add_odds_arguments(parser)
+    add_metrics_arguments(parser)
+
+    # Optional verbosity counter (eg. -v, -vv, -vvv, etc.)
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="count",
+        default=0,
+        help="Verbosity (-v, -vv, etc)")
+
+    # Specify output of "--version"
+    parser.add_argument(
+        "--version",
+        action="version",
+        version="%(prog)s (version {version})".format(version=__version__))
+
+    args = parser.parse_args()
+    main(args)
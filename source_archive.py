@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+""" Content-addressed archive of the raw event responses of every run, for offline reprocessing.
+
+Record with `--source-archive DIR` on any of the scraping scripts. Then map an archived race again with
+`python source_archive.py DIR EVENT_ID` (add `--resulted` for a result). """
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime, timezone
+from urllib.parse import urlparse, parse_qs
+from logzero import logger, loglevel
+from http_cache import build_response, endpoint_name
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+INDEX_FILE = "index.jsonl"
+# Endpoints whose responses are archived, and the key their events are listed under
+ARCHIVED_ENDPOINTS = {
+    "events-by-ids": "events",
+    "resulted-events": "eventResults"
+}
+CODECS = {"gzip": ".gz", "zstd": ".zst"}
+
+
+def url_event_ids(url):
+    """ Event ids requested by an events-by-ids or resulted-events URL """
+    return [x for x in ",".join(parse_qs(urlparse(url).query).get("eventIds", [])).split(",") if x]
+
+
+class SourceArchive:
+    """ Stores the raw bytes of each event response compressed, once per distinct payload, under the sha256 of the
+    uncompressed bytes. `index.jsonl` gets one line per fetch with the URL, time, event ids and hash, so a payload
+    that did not change between polls costs one index line. """
+
+    def __init__(self, directory, codec="gzip"):
+        if codec == "zstd" and zstandard is None:
+            raise RuntimeError("zstd compression of the source archive requires the zstandard package")
+        self.directory = directory
+        self.codec = codec
+        self.lock = threading.Lock()
+        self.stats = {"fetches": 0, "stored": 0, "bytes": 0, "compressed_bytes": 0}
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def archivable(url):
+        return endpoint_name(url) in ARCHIVED_ENDPOINTS
+
+    def path(self, digest, codec):
+        return os.path.join(self.directory, digest[:2], f"{digest}{CODECS[codec]}")
+
+    def compress(self, content):
+        if self.codec == "zstd":
+            return zstandard.ZstdCompressor().compress(content)
+        return gzip.compress(content)
+
+    def store(self, url, content):
+        digest = hashlib.sha256(content).hexdigest()
+        path = self.path(digest, self.codec)
+        entry = {"url": url, "timestamp": datetime.now(timezone.utc).isoformat(), "endpoint": endpoint_name(url),
+                 "event_ids": url_event_ids(url), "hash": digest, "codec": self.codec, "bytes": len(content)}
+        stored = not os.path.exists(path)
+        if stored:
+            compressed = self.compress(content)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(compressed)
+            os.replace(temp_path, path)
+        with self.lock:
+            with open(os.path.join(self.directory, INDEX_FILE), "a") as f:
+                f.write(json.dumps(entry) + "\n")
+            self.stats["fetches"] += 1
+            self.stats["bytes"] += len(content)
+            if stored:
+                self.stats["stored"] += 1
+                self.stats["compressed_bytes"] += len(compressed)
+        return digest
+
+    def index(self):
+        with open(os.path.join(self.directory, INDEX_FILE)) as f:
+            return [json.loads(x) for x in f if x.strip()]
+
+    def load(self, entry):
+        """ Raw response bytes of an index entry """
+        with open(self.path(entry["hash"], entry["codec"]), "rb") as f:
+            compressed = f.read()
+        if entry["codec"] == "zstd":
+            if zstandard is None:
+                raise RuntimeError("Reading zstd archives requires the zstandard package")
+            return zstandard.ZstdDecompressor().decompress(compressed)
+        return gzip.decompress(compressed)
+
+    def latest(self, endpoint, event_id, before=None):
+        """ Index entry of the last archived fetch of `endpoint` that included an event, optionally the last one
+        before an ISO 8601 time """
+        found = None
+        for entry in self.index():
+            if entry["endpoint"] == endpoint and str(event_id) in entry["event_ids"] and \
+                    (before is None or entry["timestamp"] < before):
+                found = entry
+        return found
+
+    def report(self):
+        logger.info(f"Source archive: {self.stats['fetches']} fetches, {self.stats['stored']} new payloads, "
+                    f"{self.stats['bytes']} bytes raw and {self.stats['compressed_bytes']} bytes stored")
+        return dict(self.stats)
+
+
+class ArchiveFetcher:
+    """ Stands in for `common.Fetcher`, answering event requests from the archive, so that archived payloads can be
+    passed through `get_event_info` / `get_resulted_event` and the import functions again """
+
+    def __init__(self, archive, before=None):
+        self.archive = archive
+        self.before = before
+
+    def get(self, url, stream=False):
+        endpoint = endpoint_name(url)
+        events = []
+        payloads = {}
+        for event_id in url_event_ids(url):
+            entry = self.archive.latest(endpoint, event_id, before=self.before)
+            if entry is None:
+                raise KeyError(f"Event id {event_id} is not in the source archive")
+            if entry["hash"] not in payloads:
+                payloads[entry["hash"]] = json.loads(self.archive.load(entry))
+            events.extend(x for x in payloads[entry["hash"]]["data"][ARCHIVED_ENDPOINTS[endpoint]]
+                          if str(x["id"]) == str(event_id))
+        content = json.dumps({"data": {ARCHIVED_ENDPOINTS[endpoint]: events}}).encode("utf-8")
+        response = build_response(url, content)
+        if stream:
+            response.raw.decode_content = True
+        return response
+
+    def keep(self, url, ttl):
+        pass
+
+    def map(self, fn, items):
+        return map(fn, items)
+
+
+if __name__ == "__main__":
+    from get_upcoming import get_event_info
+    from get_resulted import get_resulted_event
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", help="Directory archived with --source-archive")
+    parser.add_argument("event_id", help="Event id to map again")
+    parser.add_argument("--resulted", action="store_true", dest="resulted", default=False,
+                        help="Map the archived result instead of the upcoming race")
+    parser.add_argument("-r", "--race-type", action="store", dest="race_type", default="HORSE_RACING",
+                        help="Possible values: HORSE_RACING, HARNESS_RACING, GREYHOUNDS (defaults to HORSE_RACING)")
+    parser.add_argument("--before", action="store", dest="before", default=None,
+                        help="Use the last payload archived before this ISO 8601 time")
+    parser.add_argument("-v", "--verbose", action="count", default=0, help="Verbosity (-v, -vv, etc)")
+    args = parser.parse_args()
+    loglevel((5 - args.verbose) * 10)
+    fetcher = ArchiveFetcher(SourceArchive(args.directory), before=args.before)
+    get = get_resulted_event if args.resulted else get_event_info
+    print(json.dumps([get(fetcher, args.event_id, race_type=args.race_type)], indent=4))
@@ -2,30 +2,16 @@
 
 nordvpn connect nz71
 source /root/tabscraper-v2/env/bin/activate
-echo "Retrieving today's upcoming races"
-python /root/tabscraper-v2/get_upcoming.py -vvv -d 0 -o /root/tabscraper-v2/data/ -r HORSE_RACING
-python /root/tabscraper-v2/get_upcoming.py -vvv -d 0 -o /root/tabscraper-v2/data/ -r HARNESS_RACING
-python /root/tabscraper-v2/get_upcoming.py -vvv -d 0 -o /root/tabscraper-v2/data/ -r GREYHOUNDS
-echo "Retrieving tomorrow's upcoming races"
-python /root/tabscraper-v2/get_upcoming.py -vvv -d 1 -o /root/tabscraper-v2/data/ -r HORSE_RACING
-python /root/tabscraper-v2/get_upcoming.py -vvv -d 1 -o /root/tabscraper-v2/data/ -r HARNESS_RACING
-python /root/tabscraper-v2/get_upcoming.py -vvv -d 1 -o /root/tabscraper-v2/data/ -r GREYHOUNDS
-echo "Retrieving the day after tomorrow's upcoming races"
-python /root/tabscraper-v2/get_upcoming.py -vvv -d 2 -o /root/tabscraper-v2/data/ -r HORSE_RACING
-python /root/tabscraper-v2/get_upcoming.py -vvv -d 2 -o /root/tabscraper-v2/data/ -r HARNESS_RACING
-python /root/tabscraper-v2/get_upcoming.py -vvv -d 2 -o /root/tabscraper-v2/data/ -r GREYHOUNDS
-#echo "Retrieving the day after the day after tomorrow's upcoming races"
-#python /root/tabscraper-v2/get_upcoming.py -vvv -d 3 -o /root/tabscraper-v2/data/
-echo "Retrieving today's resulted races"
-python /root/tabscraper-v2/get_resulted.py -vvv -d 0 -o /root/tabscraper-v2/data/ -r HORSE_RACING
-python /root/tabscraper-v2/get_resulted.py -vvv -d 0 -o /root/tabscraper-v2/data/ -r HARNESS_RACING
-python /root/tabscraper-v2/get_resulted.py -vvv -d 0 -o /root/tabscraper-v2/data/ -r GREYHOUNDS
-echo "Retrieving yesterdays's resulted races"
-python /root/tabscraper-v2/get_resulted.py -vvv -d 1 -o /root/tabscraper-v2/data/ -r HORSE_RACING
-python /root/tabscraper-v2/get_resulted.py -vvv -d 1 -o /root/tabscraper-v2/data/ -r HARNESS_RACING
-python /root/tabscraper-v2/get_resulted.py -vvv -d 1 -o /root/tabscraper-v2/data/ -r GREYHOUNDS
+echo "Retrieving upcoming races for today, tomorrow and the day after, and resulted races for today and yesterday"
+python /root/tabscraper-v2/run_jobs.py -vvv -u 0,1,2 -p 0,1 -o /root/tabscraper-v2/data/ -r HORSE_RACING,HARNESS_RACING,GREYHOUNDS \
+    --state-file /root/tabscraper-v2/state.json --manifest /root/tabscraper-v2/manifest.json
 nordvpn d
-scp /root/tabscraper-v2/data/*.json racingcp:/home/uploader/json-data-v2/
-scp /root/tabscraper-v2/data/*.json racingcp:/home/uploader/json-data-backup-v2/
-ssh racingcp bash -c "/home/uploader/import.sh"
-rm /root/tabscraper-v2/data/*
\ No newline at end of file
+# Only races that are new or changed since the last run are written, so there may be nothing to upload
+if ls /root/tabscraper-v2/data/*.json > /dev/null 2>&1; then
+    # Only delete the files once they are uploaded and imported: the state file already counts them as written,
+    # so files that are not uploaded now must be kept for the next run to upload
+    scp /root/tabscraper-v2/data/*.json racingcp:/home/uploader/json-data-v2/ \
+        && scp /root/tabscraper-v2/data/*.json racingcp:/home/uploader/json-data-backup-v2/ \
+        && ssh racingcp bash -c "/home/uploader/import.sh" \
+        && rm /root/tabscraper-v2/data/*
+fi
\ No newline at end of file
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+__author__ = "Dustin Rasener"
+__version__ = "0.1.0"
+__license__ = "Proprietary"
+
+import argparse
+import heapq
+import itertools
+import os
+import signal
+import sys
+import time
+from functools import partial
+from logzero import logger, loglevel, logfile
+from changes import add_change_arguments, parse_start_time, tracker_from_args
+from common import (event_matches, fetch_batched, add_fetch_arguments, close_fetcher, fetcher_from_args, LOCATIONS,
+                    RACE_TYPES)
+from get_upcoming import (fetch_upcoming_event_list, fetch_event_infos, map_event_info, event_filename,
+                          write_event_info, UPCOMING_PROFILE_FIELDS, UPCOMING_PROFILE_MAPPERS)
+from get_resulted import (fetch_resulted_events, is_settled, map_resulted_event, resulted_event_filename,
+                          write_resulted_event, RESULTED_PROFILE_FIELDS, RESULTED_PROFILE_MAPPERS)
+from metrics import add_metrics_arguments, flush_metrics, metrics_from_args, report_metrics, METRICS
+from odds_store import add_odds_arguments, odds_store_from_args
+from run_jobs import partition_events, track_jobs
+
+logfile("/tmp/watch.log", maxBytes=int(1e6), backupCount=10)
+
+# Seconds between refreshes of an upcoming race, by how many seconds there are until it starts. The first row
+# that the time to the start is under wins; races further out than every row use DEFAULT_REFRESH_INTERVAL.
+REFRESH_INTERVALS = [
+    (5 * 60, 5),
+    (30 * 60, 30),
+    (2 * 60 * 60, 120),
+    (24 * 60 * 60, 600)
+]
+DEFAULT_REFRESH_INTERVAL = 30 * 60
+RESULT_INTERVAL = 60  # Seconds between checks for the result of a race that has started
+RESULT_TIMEOUT = 3 * 60 * 60  # Seconds after the start to stop waiting for a race to settle
+ACTIVE_STATUS = "ACTIVE"
+
+
+def refresh_interval(seconds_to_start):
+    for until_start, interval in REFRESH_INTERVALS:
+        if seconds_to_start < until_start:
+            return interval
+    return DEFAULT_REFRESH_INTERVAL
+
+
+class Watcher:
+    """ Keeps upcoming races fresh, most often close to their start, and picks up each result once it settles.
+
+    Every race is a job in a priority queue ordered by when it is next due. Each step takes the due jobs, most
+    urgent first (closest to the start), and refreshes up to `batch_size` of them in one request. All requests go
+    through the fetcher's rate limiter, which is the global request budget: when there is more due than the budget
+    allows, jobs wait in the queue and the races closest to their start are served first. The event lists are
+    fetched again every `list_interval` seconds to pick up new and abandoned races, after which `checkpoint` (if
+    given) is called, e.g. to save the state file and flush the metrics of a long run. """
+
+    def __init__(self, fetcher, race_types, offsets, output_dir=".", batch_size=10, stream=False, tracker=None,
+                 list_interval=15 * 60, odds_store=None, checkpoint=None, clock=time.time, sleep=time.sleep):
+        self.fetcher = fetcher
+        self.race_types = race_types
+        self.offsets = offsets
+        self.output_dir = output_dir
+        self.batch_size = max(int(batch_size), 1)
+        self.stream = stream
+        self.tracker = tracker
+        self.list_interval = list_interval
+        self.odds_store = odds_store
+        self.checkpoint = checkpoint
+        self.clock = clock
+        self.sleep = sleep
+        self.races = {}  # event_id: {"kind", "race_type", "start"}
+        self.finished = set()  # Races that have settled or were given up on, so that the lists do not re-add them
+        self.due = {}  # event_id: when its job is next due, to skip queue entries that were rescheduled
+        self.queue = []
+        self.counter = itertools.count()
+        self.lists_due = 0
+        self.stop = None  # When `run` is to return, if it was given a duration
+
+    def schedule(self, event_id, due):
+        self.due[event_id] = due
+        heapq.heappush(self.queue, (due, next(self.counter), event_id))
+
+    def drop(self, event_id):
+        self.finished.add(event_id)
+        self.races.pop(event_id, None)
+        self.due.pop(event_id, None)
+
+    def urgency(self, event_id):
+        return abs(self.races[event_id]["start"] - self.clock())
+
+    def refresh_lists(self):
+        in_locations = partial(event_matches, locations=LOCATIONS)
+        listed = set()
+        for offset_days in self.offsets:
+            events = fetch_upcoming_event_list(self.fetcher, offset_days, stream=self.stream, predicate=in_locations)
+            jobs = partition_events(events, self.race_types)
+            starts = {x["id"]: parse_start_time(x["startTime"]) for x in events if x["id"] in jobs}
+            track_jobs(self.tracker, "upcoming", offset_days, self.race_types, jobs, events)
+            listed.update(jobs)
+            for event_id, race_type in jobs.items():
+                if event_id not in self.races and event_id not in self.finished:
+                    self.races[event_id] = {"kind": "upcoming", "race_type": race_type, "start": starts[event_id]}
+                    self.schedule(event_id, self.clock())
+        now = self.clock()
+        for event_id, race in list(self.races.items()):
+            if race["kind"] == "upcoming" and race["start"] > now and event_id not in listed:
+                logger.info(f"Event id {event_id} is no longer listed, no longer watching it")
+                del self.races[event_id]
+                self.due.pop(event_id, None)
+        logger.info(f"Watching {len(self.races)} races")
+        self.lists_due = self.clock() + self.list_interval
+
+    def pop_due(self):
+        """ Remove and return the ids of every job that is due, dropping stale queue entries """
+        now = self.clock()
+        due = []
+        while self.queue and self.queue[0][0] <= now:
+            when, _, event_id = heapq.heappop(self.queue)
+            if self.due.get(event_id) == when:
+                due.append(event_id)
+        return due
+
+    def next_batch(self):
+        """ Up to `batch_size` due jobs of one kind, most urgent first. The rest stay in the queue. """
+        due = sorted(self.pop_due(), key=self.urgency)
+        if not due:
+            return None, []
+        kind = self.races[due[0]]["kind"]
+        batch = [x for x in due if self.races[x]["kind"] == kind][:self.batch_size]
+        for event_id in due:
+            if event_id not in batch:
+                self.schedule(event_id, self.due[event_id])
+        return kind, batch
+
+    def write(self, kind, event_id, event_info, filename, write_fn, started):
+        if self.tracker is not None and not self.tracker.changed(kind, event_id, event_info, filename):
+            METRICS.count("unchanged")
+            return
+        write_fn(event_info, filename)
+        if self.tracker is not None:
+            self.tracker.commit(kind, event_id, event_info, filename)
+        latency = time.monotonic() - started
+        METRICS.observe("latency", latency)
+        METRICS.count("written")
+        logger.info(f"Wrote file {filename} {latency:.2f}s after fetching it")
+
+    def refresh_upcoming(self, event_ids):
+        fetch_events = partial(fetch_event_infos, self.fetcher, stream=self.stream)
+        for event_id, source_event, error, started in fetch_batched(self.fetcher, fetch_events, event_ids,
+                                                                    self.batch_size):
+            race = self.races[event_id]
+            now = self.clock()
+            try:
+                if error is not None:
+                    raise error
+                event_info = map_event_info(source_event, race_type=race["race_type"])
+                race["start"] = parse_start_time(source_event["startTime"])
+                if self.odds_store is not None:
+                    try:
+                        self.odds_store.add_event(source_event, timestamp=now)
+                    except Exception as e:
+                        METRICS.count("errors")
+                        logger.error(f"Error while storing the odds of upcoming event id {event_id}: "
+                                     f"{sys.exc_info()[0]}")
+                        logger.exception(e)
+                self.write("upcoming", event_id, event_info, event_filename(event_info, self.output_dir),
+                           write_event_info, started)
+                if source_event.get("status") != ACTIVE_STATUS or now >= race["start"]:
+                    race["kind"] = "resulted"
+                    self.schedule(event_id, max(now, race["start"]) + RESULT_INTERVAL)
+                else:
+                    self.schedule(event_id, now + refresh_interval(race["start"] - now))
+            except Exception as e:
+                METRICS.count("errors")
+                logger.error(f"Error while refreshing upcoming event id {event_id}: {sys.exc_info()[0]}")
+                logger.exception(e)
+                if now >= race["start"]:
+                    race["kind"] = "resulted"  # Wait for its result, giving up after RESULT_TIMEOUT
+                    self.schedule(event_id, now + RESULT_INTERVAL)
+                else:
+                    self.schedule(event_id, now + refresh_interval(race["start"] - now))
+
+    def refresh_resulted(self, event_ids):
+        fetch_events = partial(fetch_resulted_events, self.fetcher, stream=self.stream)
+        # The resulted endpoint may leave out races that have no result yet, which then count as not settled
+        for event_id, source_event, error, started in fetch_batched(self.fetcher, fetch_events, event_ids,
+                                                                    self.batch_size, retry_missing=False):
+            race = self.races[event_id]
+            now = self.clock()
+            try:
+                if error is not None:
+                    raise error
+                if source_event is not None and is_settled(source_event):
+                    event_info = map_resulted_event(source_event, race_type=race["race_type"])
+                    self.write("resulted", event_id, event_info,
+                               resulted_event_filename(event_info, self.output_dir), write_resulted_event, started)
+                    self.drop(event_id)
+                    continue
+            except Exception as e:
+                METRICS.count("errors")
+                logger.error(f"Error while checking result of event id {event_id}: {sys.exc_info()[0]}")
+                logger.exception(e)
+            if now - race["start"] > RESULT_TIMEOUT:
+                logger.warning(f"Event id {event_id} has not settled {RESULT_TIMEOUT}s after its start, giving up")
+                self.drop(event_id)
+            else:
+                self.schedule(event_id, now + RESULT_INTERVAL)
+
+    def step(self):
+        """ Refresh the event lists if they are due, then the most urgent batch of due races, or sleep until the
+        next job is due (or the run is to stop) """
+        if self.clock() >= self.lists_due:
+            try:
+                self.refresh_lists()
+            except Exception as e:
+                METRICS.count("errors")
+                logger.error(f"Error while refreshing the event lists: {sys.exc_info()[0]}")
+                logger.exception(e)
+                self.lists_due = self.clock() + min(self.list_interval, RESULT_INTERVAL)
+            if self.checkpoint is not None:
+                try:
+                    self.checkpoint()
+                except Exception as e:
+                    METRICS.count("errors")
+                    logger.error(f"Error while saving progress: {sys.exc_info()[0]}")
+                    logger.exception(e)
+        kind, batch = self.next_batch()
+        if not batch:
+            next_due = min([self.lists_due] + [x[0] for x in self.queue[:1]] +
+                           ([self.stop] if self.stop is not None else []))
+            self.sleep(max(next_due - self.clock(), 0))
+        elif kind == "upcoming":
+            self.refresh_upcoming(batch)
+        else:
+            self.refresh_resulted(batch)
+
+    def run(self, duration=None):
+        """ Step until interrupted, or for `duration` seconds """
+        self.stop = None if duration is None else self.clock() + duration
+        while self.stop is None or self.clock() < self.stop:
+            self.step()
+
+
+def main(args):
+    loglevel((5 - args.verbose) * 10)  # -v for error+critical, up to -vvvv for debug+
+    exporter = metrics_from_args(args)
+    race_types = args.race_types.split(",")
+    for race_type in race_types:
+        if race_type not in RACE_TYPES:
+            raise ValueError(f"Unknown race type {race_type}")
+    fetcher = fetcher_from_args(args, {**UPCOMING_PROFILE_FIELDS, **RESULTED_PROFILE_FIELDS},
+                                {**UPCOMING_PROFILE_MAPPERS, **RESULTED_PROFILE_MAPPERS})
+    tracker = tracker_from_args(args)
+    os.makedirs(args.output_dir, exist_ok=True)
+    odds_store = odds_store_from_args(args)
+
+    def checkpoint():
+        if tracker is not None:
+            tracker.save()
+        flush_metrics(args, exporter)
+
+    watcher = Watcher(fetcher, race_types,
+                      offsets=[x for x in args.upcoming_days.split(",") if x != ""],
+                      output_dir=args.output_dir,
+                      batch_size=args.batch_size,
+                      stream=args.stream,
+                      tracker=tracker,
+                      list_interval=args.list_interval,
+                      odds_store=odds_store,
+                      checkpoint=checkpoint)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)  # Save state on SIGTERM as well as on Ctrl-C
+    try:
+        watcher.run(args.duration)
+    except KeyboardInterrupt:
+        logger.info("Stopping")
+    if odds_store is not None:
+        odds_store.close()
+    if tracker is not None:
+        tracker.finish(args.manifest)
+    close_fetcher(fetcher, args)
+    report_metrics(args, exporter)
+
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-o", "--output_dir", action="store", dest="output_dir", default="./events")
+    parser.add_argument("-u", "--upcoming-days", action="store", dest="upcoming_days", default="0,1",
+                        help="Comma-separated days in the future to watch races for (defaults to 0,1)")
+    parser.add_argument("-r", "--race-types", action="store", dest="race_types",
+                        default="HORSE_RACING,HARNESS_RACING,GREYHOUNDS",
+                        help="Comma-separated race types (defaults to HORSE_RACING,HARNESS_RACING,GREYHOUNDS)")
+    parser.add_argument("--list-interval", action="store", dest="list_interval", type=float, default=15 * 60,
+                        help="Seconds between refreshes of the event lists (defaults to 900)")
+    parser.add_argument("--duration", action="store", dest="duration", type=float, default=None,
+                        help="Stop after this many seconds (runs until interrupted by default)")
+    add_fetch_arguments(parser)
+    add_change_arguments(parser)
+    add_odds_arguments(parser)
+    add_metrics_arguments(parser)
+
+    # Optional verbosity counter (eg. -v, -vv, -vvv, etc.)
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="count",
+        default=0,
+        help="Verbosity (-v, -vv, etc)")
+
+    # Specify output of "--version"
+    parser.add_argument(
+        "--version",
+        action="version",
+        version="%(prog)s (version {version})".format(version=__version__))
+
+    args = parser.parse_args()
+    main(args)